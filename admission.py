@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(message)
+        # 429: the queue is full, 503: no slot freed up in time (or shed for a higher priority)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """Caps the requests of one pool running at once, queueing the rest by priority
+
+    At most max_concurrent requests run; up to max_queue more wait, best priority (lowest index
+    in priorities) first and then in arrival order. A request that finds the queue full is
+    rejected, unless a worse-priority request is waiting, which is shed in its place. A request
+    waits at most queue_timeout, or until its own deadline, whichever comes first.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float,
+                 priorities: Sequence[str] = ("default",)):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.priorities = tuple(priorities)
+        self.in_flight = 0
+        # (priority, arrival, future); futures of waiters that gave up stay until popped
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._queued = [0] * len(self.priorities)
+        self._arrivals = itertools.count()
+        self._avg_service_seconds = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.shed = 0
+
+    def retry_after(self) -> int:
+        backlog = sum(self._queued) + 1
+        return max(1, math.ceil(self._avg_service_seconds * backlog / self.max_concurrent))
+
+    def _reject(self, message: str, status_code: int, reason: str) -> AdmissionRejected:
+        ADMISSION_REJECTED.inc(pool=self.name, reason=reason)
+        return AdmissionRejected(message, status_code, self.retry_after(), reason)
+
+    async def acquire(self, priority: str = "default", deadline: Optional[float] = None) -> None:
+        """Wait for a slot; raises AdmissionRejected instead of queueing past the limits"""
+        level = self.priorities.index(priority)
+        started = time.monotonic()
+        if self.in_flight < self.max_concurrent and not sum(self._queued):
+            self.in_flight += 1
+            self.admitted += 1
+            ADMISSION_WAIT_SECONDS.observe(0.0, pool=self.name, priority=priority)
+            return
+        if sum(self._queued) >= self.max_queue and not self._shed_worse_than(level):
+            self.rejected += 1
+            raise self._reject(f"Too many {self.name} requests waiting", 429, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (level, next(self._arrivals), waiter))
+        self._queued[level] += 1
+        timeout = self.queue_timeout if deadline is None else min(self.queue_timeout, deadline - started)
+        try:
+            await asyncio.wait({waiter}, timeout=max(timeout, 0.0))
+        except asyncio.CancelledError:
+            if not self._abandon(waiter, level) and waiter.exception() is None:
+                # The slot was handed over just as the caller went away
+                self.release()
+            raise
+        if self._abandon(waiter, level):
+            self.timed_out += 1
+            raise self._reject(f"No {self.name} slot free within {timeout:.1f}s", 503, "timeout")
+        # Set when the waiter was shed for a better-priority request
+        waiter.result()
+        self.admitted += 1
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, pool=self.name, priority=priority)
+
+    def _abandon(self, waiter: asyncio.Future, level: int) -> bool:
+        """Give up waiting; False if the waiter was already granted a slot or shed"""
+        if waiter.done():
+            return False
+        waiter.cancel()
+        self._queued[level] -= 1
+        return True
+
+    def _shed_worse_than(self, level: int) -> bool:
+        live = [entry for entry in self._waiters if not entry[2].done()]
+        if not live:
+            return False
+        worst = max(live, key=lambda entry: (entry[0], -entry[1]))
+        if worst[0] <= level:
+            return False
+        worst_level, _, waiter = worst
+        self._queued[worst_level] -= 1
+        self.shed += 1
+        waiter.set_exception(self._reject(f"Shed for a higher-priority {self.name} request", 503, "shed"))
+        return True
+
+    def release(self, service_seconds: Optional[float] = None) -> None:
+        if service_seconds is not None:
+            self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * service_seconds
+        # The slot passes straight to the best waiter, so in_flight only drops when nobody waits
+        while self._waiters:
+            level, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self._queued[level] -= 1
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "queued": sum(self._queued),
+            "queued_by_priority": dict(zip(self.priorities, self._queued)),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "shed": self.shed,
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware admitting the routes in routes through their pool's controller
+
+    routes maps (method, path) to (controller, priority). It runs before the request body is
+    read, so a rejected upload is never received, and holds the slot until the response,
+    streamed or not, has been sent.
+    """
+
+    def __init__(self, app, routes: Dict[Tuple[str, str], Tuple[AdmissionController, str]]):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send) -> None:
+        route = self.routes.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        controller, priority = route
+        # Set by the request-deadline middleware when it runs first
+        deadline = getattr(Request(scope).state, "deadline", None)
+        try:
+            await controller.acquire(priority, deadline)
+        except AdmissionRejected as e:
+            response = JSONResponse({"detail": str(e)}, status_code=e.status_code,
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(time.monotonic() - started)
@@ -1,10 +1,18 @@
 import os
+import json
+import asyncio
 import uvicorn
-from typing import Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
+from typing import Dict, Any, List, Optional
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from textRAG import textRAG
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from textRAG import textRAG, DEFAULT_SESSION
+from ingestion import UPLOAD_CHUNK_SIZE, IngestionQueue, MultipartUpload, QueueFullError, UploadTooLargeError
+from metrics import CONTENT_TYPE, REGISTRY, REQUEST_SECONDS
+from llm_guard import LLMUnavailableError
+from admission import AdmissionController, AdmissionMiddleware
+import time
 import tempfile
 import shutil
 from pathlib import Path
@@ -26,22 +34,169 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup_db_client():
-    app.rag_pipeline = textRAG(folder_path="pdfs", resume_file="ManishKumarResume.pdf")
+    # Models load in the background so the port (and /health) is up immediately; /ready reports warm-up
+    app.rag_pipeline = textRAG(folder_path="pdfs", resume_file="ManishKumarResume.pdf", warm_up=False)
+    app.ingestion_queue = IngestionQueue(app.rag_pipeline,
+                                         workers=int(os.getenv("RAG_INGESTION_PROCESSES", "2")),
+                                         max_depth=int(os.getenv("RAG_INGESTION_QUEUE_DEPTH", "16")))
+    app.warm_up_task = asyncio.ensure_future(asyncio.to_thread(app.rag_pipeline.warm_up))
+    # Existing cache, batcher and queue counters are read when /metrics is scraped
+    REGISTRY.add_stats_collector("rag", app.rag_pipeline.cache_stats,
+                                 counters=("hits", "misses", "evictions", "batches", "items", "started", "coalesced",
+                                           "reranked", "over_budget", "pairs_scored", "attempts", "retries", "hedges",
+                                           "hedge_wins", "timeouts", "failures", "short_circuited",
+                                           "deadline_exceeded", "exhausted", "opened", "summarized", "evicted",
+                                           "expired"))
+    REGISTRY.add_stats_collector("rag_ingestion_queue", app.ingestion_queue.stats)
+    for controller in (query_admission, upload_admission):
+        REGISTRY.add_stats_collector(f"rag_admission_{controller.name}", controller.stats,
+                                     counters=("admitted", "rejected", "timed_out", "shed"))
+
+READY_TIMEOUT = float(os.getenv("RAG_READY_TIMEOUT_SECONDS", "60"))
+
+async def require_ready():
+    # Requests that arrive during warm-up wait for it rather than failing
+    if app.rag_pipeline.ready.is_set():
+        return
+    try:
+        await asyncio.wait_for(asyncio.shield(app.warm_up_task), timeout=READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Models are still loading", headers={"Retry-After": "5"})
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Warm-up failed: {e}")
+
+MAX_UPLOAD_BYTES = int(os.getenv("RAG_MAX_UPLOAD_MB", "50")) * 1024 * 1024
+UPLOAD_SPOOL_DIR = os.getenv("RAG_UPLOAD_SPOOL_DIR") or None
+# Multipart boundaries and the session_id field on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Admission control: queries and uploads each get a concurrency cap and a bounded, prioritized
+# queue, so a burst is turned away with Retry-After instead of slowing down every accepted request
+query_admission = AdmissionController(
+    "query",
+    max_concurrent=int(os.getenv("RAG_QUERY_CONCURRENCY", "32")),
+    max_queue=int(os.getenv("RAG_QUERY_QUEUE", "64")),
+    queue_timeout=float(os.getenv("RAG_QUERY_QUEUE_TIMEOUT_SECONDS", "5")),
+    priorities=("interactive", "batch"),
+)
+upload_admission = AdmissionController(
+    "upload",
+    max_concurrent=int(os.getenv("RAG_UPLOAD_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("RAG_UPLOAD_QUEUE", "8")),
+    queue_timeout=float(os.getenv("RAG_UPLOAD_QUEUE_TIMEOUT_SECONDS", "10")),
+)
+# Added before the deadline middleware so it runs inside it and queueing counts against the deadline
+app.add_middleware(AdmissionMiddleware, routes={
+    ("POST", "/query"): (query_admission, "interactive"),
+    ("POST", "/query/stream"): (query_admission, "interactive"),
+    ("POST", "/query/batch"): (query_admission, "batch"),
+    ("POST", "/upload"): (upload_admission, "default"),
+})
+
+REQUEST_TIMEOUT = float(os.getenv("RAG_REQUEST_TIMEOUT_SECONDS", "30"))
+
+@app.middleware("http")
+async def set_request_deadline(request, call_next):
+    # The deadline starts when the request arrives, so warm-up and retrieval time count against it.
+    # X-Request-Timeout (seconds) lets a caller with a tighter budget shorten it, never extend it
+    timeout = REQUEST_TIMEOUT
+    try:
+        timeout = min(timeout, float(request.headers.get("x-request-timeout", timeout)))
+    except ValueError:
+        pass
+    request.state.deadline = time.monotonic() + timeout
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_latency(request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The route template (/jobs/{job_id}), not the raw path, keeps label cardinality bounded
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=status)
+
+@app.middleware("http")
+async def reject_oversized_uploads(request, call_next):
+    # A declared length is refused before the body is read; a chunked body is cut off by the upload
+    # endpoint once the file part passes MAX_UPLOAD_BYTES
+    if request.url.path == "/upload":
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+            return JSONResponse({"detail": str(UploadTooLargeError(MAX_UPLOAD_BYTES))}, status_code=413)
+        # No point receiving a file the ingestion queue would refuse
+        if app.ingestion_queue.full():
+            error = QueueFullError(app.ingestion_queue.retry_after())
+            return JSONResponse({"detail": str(error)}, status_code=429,
+                                headers={"Retry-After": str(error.retry_after)})
+    return await call_next(request)
+
+@app.on_event("shutdown")
+async def shutdown_db_client():
+    app.ingestion_queue.close()
+    app.rag_pipeline.close()
 
 # Query model
-class QueryRequest(BaseModel):
+MAX_FETCH_K = int(os.getenv("RAG_MAX_FETCH_K", "500"))
+
+class RetrievalOptions(BaseModel):
+    # Unset values fall back to RAG_MMR_K / RAG_MMR_FETCH_K / RAG_MMR_LAMBDA
+    model_config = ConfigDict(populate_by_name=True)
+    k: Optional[int] = Field(None, ge=1, le=50)
+    fetch_k: Optional[int] = Field(None, ge=1, le=MAX_FETCH_K)
+    lambda_mult: Optional[float] = Field(None, ge=0.0, le=1.0, alias="lambda")
+    # Cross-encoder reranking for this request; defaults to RAG_RERANK
+    rerank: Optional[bool] = None
+
+    def retrieval_kwargs(self) -> Dict[str, Any]:
+        return {"k": self.k, "fetch_k": self.fetch_k, "lambda_mult": self.lambda_mult, "use_reranker": self.rerank}
+
+class QueryRequest(RetrievalOptions):
     query: str
+    session_id: str = DEFAULT_SESSION
     # collection_name: Optional[str] = "documents"
     # temperature: Optional[float] = 0.2
     # max_tokens: Optional[int] = 1024
 
+class BatchQueryRequest(RetrievalOptions):
+    queries: List[str]
+    session_id: str = DEFAULT_SESSION
+    max_concurrency: Optional[int] = Field(None, ge=1)
+
 class DocumentUploadRequest(BaseModel):
     pdf_directory: str = "pdfs"
     
 # Response models
-class QueryResponse(BaseModel):
+class ContextTokens(BaseModel):
+    # Counted with the embedding tokenizer: everything retrieved vs. the packed context sent to Gemini
+    retrieved_tokens: Optional[int] = None
+    context_tokens: Optional[int] = None
+    retrieved_chunks: Optional[int] = None
+    context_chunks: Optional[int] = None
+    duplicates_dropped: Optional[int] = None
+    truncated: Optional[bool] = None
+
+class QueryResponse(ContextTokens):
     answer: str
     source_documents: Optional[str] = None
+    # Gemini was unavailable or too slow: answer is a notice and source_documents the retrieved context
+    degraded: bool = False
+    # Set when a follow-up question was expanded with the session's previous question for retrieval
+    retrieval_query: Optional[str] = None
+
+class BatchQueryItem(ContextTokens):
+    query: str
+    answer: Optional[str] = None
+    source_documents: Optional[str] = None
+    error: Optional[str] = None
+    degraded: bool = False
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchQueryItem]
 
 class DocumentsResponse(BaseModel):
     message: str
@@ -51,24 +206,119 @@ class UploadResponse(BaseModel):
     message: str
     filename: str
     success: bool
+    fingerprint: Optional[str] = None
+    deduplicated: bool = False
+    job_id: Optional[str] = None
+    status: str = "queued"
+
+class JobResponse(BaseModel):
+    job_id: str
+    filename: str
+    fingerprint: str
+    stage: str
+    progress: float
+    chunk_count: int
+    error: Optional[str] = None
+    tier_seconds: Dict[str, float] = {}
+    tier_pages: Dict[str, int] = {}
+    created_at: float
+    updated_at: float
 
 class ListResponse(BaseModel):
     documents: list
 
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest):
+DEGRADED_ANSWER = ("The answer service is unavailable right now. "
+                   "The most relevant passages from your documents are below.")
+
+@app.post("/query", response_model=QueryResponse, dependencies=[Depends(require_ready)])
+async def query(request: QueryRequest, http_request: Request):
     try:
-        context = app.rag_pipeline.query_documents(request.query)
-        answer = app.rag_pipeline.generate_response(request.query, context)
+        retrieval_query, history = app.rag_pipeline.contextualize_query(request.query, request.session_id)
+        rewritten = retrieval_query if retrieval_query != request.query else None
+        context = await app.rag_pipeline.aquery_context(retrieval_query, session_id=request.session_id,
+                                                        **request.retrieval_kwargs())
+        try:
+            answer = await app.rag_pipeline.agenerate_response(request.query, context.text,
+                                                               deadline=http_request.state.deadline, history=history)
+        except LLMUnavailableError as e:
+            print(f"Answering from context only: {e}")
+            return QueryResponse(answer=DEGRADED_ANSWER, source_documents=context.text, degraded=True,
+                                 retrieval_query=rewritten, **context.token_counts())
         print(f"Answer: {answer}")
-        return QueryResponse(answer=answer, source_documents=context)
+        # Fallback notices are not remembered; the next question follows on from the last real answer
+        app.rag_pipeline.remember_turn(request.session_id, request.query, answer)
+        return QueryResponse(answer=answer, source_documents=context.text, retrieval_query=rewritten,
+                             **context.token_counts())
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+MAX_BATCH_SIZE = int(os.getenv("RAG_MAX_BATCH_SIZE", "1000"))
+
+@app.post("/query/batch", response_model=BatchQueryResponse, dependencies=[Depends(require_ready)])
+async def query_batch(request: BatchQueryRequest):
+    if len(request.queries) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_SIZE} queries per batch")
+    try:
+        results = await app.rag_pipeline.aquery_batch(request.queries, session_id=request.session_id,
+                                                      max_concurrency=request.max_concurrency,
+                                                      **request.retrieval_kwargs())
+        return BatchQueryResponse(results=[BatchQueryItem(**result) for result in results])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/query/stream", dependencies=[Depends(require_ready)])
+async def query_stream(request: QueryRequest, http_request: Request):
+    deadline = http_request.state.deadline
+
+    async def event_stream():
+        try:
+            retrieval_query, history = app.rag_pipeline.contextualize_query(request.query, request.session_id)
+            context = await app.rag_pipeline.aquery_context(retrieval_query, session_id=request.session_id,
+                                                            **request.retrieval_kwargs())
+            # Sources go out first so clients can render them while Gemini is still generating
+            yield _sse_event("sources", {"source_documents": context.text, "retrieval_query": retrieval_query,
+                                         **context.token_counts()})
+            tokens = []
+            try:
+                async for token in app.rag_pipeline.astream_response(request.query, context.text, deadline,
+                                                                     history=history):
+                    tokens.append(token)
+                    yield _sse_event("token", {"text": token})
+            except LLMUnavailableError as e:
+                # The sources event already carried the context; the answer so far may be cut short
+                yield _sse_event("degraded", {"detail": str(e), "reason": e.reason})
+            else:
+                app.rag_pipeline.remember_turn(request.session_id, request.query, "".join(tokens))
+            yield _sse_event("done", {})
+        except Exception as e:
+            yield _sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    readiness = app.rag_pipeline.readiness()
+    return JSONResponse(readiness, status_code=200 if readiness["status"] == "ready" else 503)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.get("/stats")
+async def stats():
+    return {**app.rag_pipeline.cache_stats(), "ingestion_queue": app.ingestion_queue.stats(),
+            "admission": {"query": query_admission.stats(), "upload": upload_admission.stats()}}
 
 @app.get("/loadedpdfs", response_model=ListResponse)
 async def loaded_pdfs():
@@ -78,31 +328,88 @@ async def loaded_pdfs():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/upload", response_model=UploadResponse)
-async def upload_file(file: UploadFile = File(...)):
+# The body is parsed by hand (see upload_file), so the form is declared here for the docs
+UPLOAD_FORM_SCHEMA = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "required": ["file"],
+    "properties": {"file": {"type": "string", "format": "binary"},
+                   "session_id": {"type": "string", "default": DEFAULT_SESSION}}}}}}}
+
+@app.post("/upload", response_model=UploadResponse, status_code=202, dependencies=[Depends(require_ready)],
+          openapi_extra=UPLOAD_FORM_SCHEMA)
+async def upload_file(request: Request):
+    try:
+        upload = MultipartUpload(request.headers.get("content-type", ""), max_bytes=MAX_UPLOAD_BYTES,
+                                 spool_dir=UPLOAD_SPOOL_DIR)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    handed_off = False
     try:
-        if not file.filename.endswith('.pdf'):
+        # The body goes from the socket to the spool file as it arrives, in blocks of up to
+        # UPLOAD_CHUNK_SIZE; parsing and disk writes run in a thread, off the event loop
+        buffer = bytearray()
+        async for data in request.stream():
+            buffer += data
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await asyncio.to_thread(upload.write, bytes(buffer))
+                buffer.clear()
+            if upload.filename is not None and not upload.filename.endswith('.pdf'):
+                raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+        await asyncio.to_thread(upload.write, bytes(buffer))
+        fingerprint = await asyncio.to_thread(upload.finish)
+        filename = upload.filename
+        if not filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
-        
-        # Read file content
-        file_content = await file.read()
-        
-        # Add to RAG pipeline as temporary document
-        temp_path = app.rag_pipeline.add_temporary_document(file_content, file.filename)
-        
+        session_id = upload.fields.get("session_id", DEFAULT_SESSION)
+
+        # Same bytes already indexed: visible to this session right away
+        if app.rag_pipeline.link_fingerprint(fingerprint, session_id):
+            return UploadResponse(
+                message=f"File {filename} was already indexed and is now available for this session",
+                filename=filename,
+                success=True,
+                fingerprint=fingerprint,
+                deduplicated=True,
+                status="indexed",
+            )
+
+        handed_off = True
+        job = app.ingestion_queue.submit(upload.spool.path, filename, fingerprint, session_id)
         return UploadResponse(
-            message=f"File {file.filename} uploaded and indexed successfully",
-            filename=file.filename,
-            success=True
+            message=f"File {filename} queued for indexing",
+            filename=filename,
+            success=True,
+            fingerprint=fingerprint,
+            job_id=job.job_id,
+            status=job.stage,
         )
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not handed_off:
+            await asyncio.to_thread(upload.discard)
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def job_status(job_id: str):
+    job = app.ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return JobResponse(**job.to_dict())
 
-@app.post("/cleanup-session")
-async def cleanup_session():
+@app.post("/cleanup-session", dependencies=[Depends(require_ready)])
+async def cleanup_session(session_id: str = DEFAULT_SESSION):
     try:
-        app.rag_pipeline.cleanup_session_documents()
-        return {"message": "Session documents cleaned up successfully"}
+        # Pending uploads first, so none of them links its document to the session afterwards
+        app.ingestion_queue.cancel_session(session_id)
+        await app.rag_pipeline.acleanup_session_documents(session_id)
+        return {"message": "Session documents and history cleaned up successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -0,0 +1,147 @@
+"""Compare full-Docling extraction with the tiered text-layer/Docling path
+
+    python -m benchmarks.extraction_benchmark --corpus pdfs --workers 4
+    python -m benchmarks.extraction_benchmark --generate-mixed 8 --workers 4
+
+For every PDF, the baseline converts the whole file with Docling in one worker (the previous
+behaviour). The tiered run classifies pages, sends text-layer pages to the lightweight
+extractor and the rest to Docling, with page runs spread over the worker pool. Both chunk
+with HybridChunker. Reports pages and seconds per tier, wall time and speedup.
+"""
+import argparse
+import ctypes
+import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+from ingestion import TierStats, _init_worker, convert_pages
+from tiered_extraction import DOCLING_TIER, plan_tasks
+
+EMBEDDING_MODEL = "avsolatorio/GIST-large-Embedding-v0"
+PARAGRAPH = ("Designed and shipped data pipelines in Python, processing event streams with Spark and "
+             "serving features to machine learning models behind a FastAPI service.")
+
+
+def _text_page(pdf, lines: List[str]):
+    import pypdfium2.raw as pdfium_c
+
+    page = pdf.new_page(612, 792)
+    y = 740
+    for line in lines:
+        text = pdfium_c.FPDFPageObj_NewTextObj(pdf.raw, b"Helvetica", 11)
+        buffer = ctypes.create_string_buffer(line.encode("utf-16-le") + b"\0\0")
+        pdfium_c.FPDFText_SetText(text, ctypes.cast(buffer, ctypes.POINTER(pdfium_c.FPDF_WCHAR)))
+        pdfium_c.FPDFPageObj_Transform(text, 1, 0, 0, 1, 60, y)
+        pdfium_c.FPDFPage_InsertObject(page.raw, text)
+        y -= 15
+    page.gen_content()
+    return page
+
+
+def generate_mixed_corpus(output_dir: Path, documents: int, pages: int = 6, scanned_every: int = 3) -> None:
+    """Born-digital PDFs where every scanned_every-th page is an image of text, as a scanner produces"""
+    import pypdfium2 as pdfium
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for number in range(documents):
+        pdf = pdfium.PdfDocument.new()
+        for page_number in range(pages):
+            lines = [f"{number}.{page_number}.{line} {PARAGRAPH[:60]}" for line in range(40)]
+            if page_number % scanned_every == scanned_every - 1:
+                scratch = pdfium.PdfDocument.new()
+                bitmap = _text_page(scratch, lines).render(scale=2)
+                image = pdfium.PdfImage.new(pdf)
+                image.set_bitmap(bitmap)
+                image.set_matrix(pdfium.PdfMatrix().scale(612, 792))
+                page = pdf.new_page(612, 792)
+                page.insert_obj(image)
+                page.gen_content()
+            else:
+                _text_page(pdf, lines)
+        pdf.save(str(output_dir / f"mixed_{number:03d}.pdf"))
+
+
+def _drain(progress_queue) -> None:
+    while progress_queue.get() is not None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default="pdfs", help="Folder of PDFs to extract")
+    parser.add_argument("--generate-mixed", type=int, default=0, metavar="N",
+                        help="Benchmark N generated PDFs mixing text-layer and scanned pages instead of --corpus")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--pages-per-task", type=int, default=4)
+    parser.add_argument("--min-chars", type=int, default=200)
+    parser.add_argument("--skip-baseline", action="store_true")
+    parser.add_argument("--output", default="extraction_benchmark.json")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="extraction-bench-"))
+    corpus = Path(args.corpus)
+    if args.generate_mixed:
+        corpus = workdir / "corpus"
+        generate_mixed_corpus(corpus, args.generate_mixed)
+    files = sorted(str(path) for path in corpus.rglob("*.pdf"))
+    if not files:
+        print(f"No PDFs found in {corpus}")
+        return
+
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    threading.Thread(target=_drain, args=(progress_queue,), daemon=True).start()
+    report = {"config": vars(args), "files": len(files)}
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(progress_queue, EMBEDDING_MODEL)) as pool:
+            # One Docling page per worker loads the layout models, so neither run pays for start-up
+            warmups = [pool.submit(convert_pages, "warmup", files[0], DOCLING_TIER, 1, 1) for _ in range(args.workers)]
+            for future in warmups:
+                future.result()
+
+            if not args.skip_baseline:
+                started = time.time()
+                futures = [pool.submit(convert_pages, "baseline", path, DOCLING_TIER, None, None) for path in files]
+                baseline_chunks = sum(len(future.result()[0]) for future in futures)
+                report["baseline"] = {"wall_seconds": round(time.time() - started, 3), "chunks": baseline_chunks}
+                print(f"Full Docling: {report['baseline']['wall_seconds']:.2f}s, {baseline_chunks} chunks")
+
+            stats = TierStats()
+            started = time.time()
+            futures = []
+            for path in files:
+                classify_started = time.time()
+                tasks = plan_tasks(path, min_chars=args.min_chars, pages_per_task=args.pages_per_task)
+                stats.seconds["classify"] = stats.seconds.get("classify", 0.0) + time.time() - classify_started
+                futures += [(task, pool.submit(convert_pages, "tiered", path, *task)) for task in tasks]
+            tiered_chunks = 0
+            for task, future in futures:
+                texts, timings = future.result()
+                tiered_chunks += len(texts)
+                stats.add(task, timings)
+            report["tiered"] = {"wall_seconds": round(time.time() - started, 3), "chunks": tiered_chunks,
+                                **stats.to_dict()}
+            print(f"Tiered: {report['tiered']['wall_seconds']:.2f}s, {tiered_chunks} chunks, "
+                  f"pages per tier {stats.pages}, seconds per tier {report['tiered']['seconds']}")
+            if "baseline" in report:
+                report["speedup"] = round(report["baseline"]["wall_seconds"] / max(report["tiered"]["wall_seconds"],
+                                                                                   1e-9), 2)
+                print(f"Speedup: {report['speedup']}x")
+    finally:
+        progress_queue.put(None)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Local, deterministic stand-in for the Gemini generateContent REST API
+
+    python -m benchmarks.fake_gemini --port 8765 --first-token-ms 300 --token-ms 15
+
+Point textRAG at it with RAG_GEMINI_ENDPOINT=http://127.0.0.1:8765 (the REST transport is then
+used). Answers are built from a hash of the prompt, so the same question and context always get
+the same reply, after --first-token-ms plus --token-ms per streamed chunk. To exercise timeouts,
+retries and the circuit breaker, --error-rate of the requests fail with 503 and --slow-rate of
+them wait an extra --slow-ms before the first token (drawn from a seeded generator).
+"""
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+WORDS = ("the", "candidate", "built", "pipelines", "with", "python", "and", "deployed", "models", "on", "cloud",
+         "services", "using", "fastapi", "docker", "experience", "includes", "retrieval", "systems", "for", "search")
+
+
+def answer_chunks(prompt: str, tokens: int, words_per_chunk: int = 4) -> List[str]:
+    seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+    words = [WORDS[(seed >> (i % 200)) % len(WORDS)] for i in range(tokens)]
+    return [" ".join(words[i:i + words_per_chunk]) + " " for i in range(0, len(words), words_per_chunk)]
+
+
+def _response(text: str, prompt_tokens: int, output_tokens: int, finished: bool) -> dict:
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if finished:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                              "totalTokenCount": prompt_tokens + output_tokens}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeGeminiServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self) -> None:
+        path, _, query = self.path.partition("?")
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        prompt = "".join(part.get("text", "") for content in body.get("contents", [])
+                         for part in content.get("parts", []))
+        prompt_tokens = len(prompt.split())
+        chunks = answer_chunks(prompt, self.server.answer_tokens)
+        fail, extra_delay = self.server.record_request()
+        if fail:
+            payload = json.dumps({"error": {"code": 503, "message": "Injected failure", "status": "UNAVAILABLE"}})
+            self.send_response(503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload.encode())
+            return
+
+        if path.endswith(":generateContent"):
+            time.sleep(self.server.first_token_s + extra_delay + self.server.token_s * (len(chunks) - 1))
+            payload = json.dumps(_response("".join(chunks), prompt_tokens, self.server.answer_tokens, True)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if not path.endswith(":streamGenerateContent"):
+            self.send_error(404, f"Unknown method {path}")
+            return
+
+        # alt=sse is the public REST API's event stream; without it the GAPIC REST client expects a JSON array
+        sse = "alt=sse" in query
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(self.server.first_token_s + extra_delay)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(self.server.token_s)
+            event = json.dumps(_response(chunk, prompt_tokens, self.server.answer_tokens, i == len(chunks) - 1))
+            if sse:
+                self._send_chunk(f"data: {event}\r\n\r\n".encode())
+            else:
+                self._send_chunk((("[" if i == 0 else ",") + event).encode())
+        if not sse:
+            self._send_chunk(b"]")
+        self._send_chunk(b"")
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0), first_token_ms: float = 300.0,
+                 token_ms: float = 15.0, answer_tokens: int = 120, error_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_ms: float = 0.0, seed: int = 0):
+        super().__init__(address, _Handler)
+        self.first_token_s = first_token_ms / 1000.0
+        self.token_s = token_ms / 1000.0
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_s = slow_ms / 1000.0
+        self.requests = 0
+        self.failed = 0
+        self.slowed = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_request(self) -> Tuple[bool, float]:
+        """Count a request and draw its injected fault: (fail with 503, extra first-token delay)"""
+        with self._lock:
+            self.requests += 1
+            if self._random.random() < self.error_rate:
+                self.failed += 1
+                return True, 0.0
+            if self._random.random() < self.slow_rate:
+                self.slowed += 1
+                return False, self.slow_s
+            return False, 0.0
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients drop connections on purpose (timed-out attempts, losing hedges)
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def start(self) -> "FakeGeminiServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-token-ms", type=float, default=300.0)
+    parser.add_argument("--token-ms", type=float, default=15.0)
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of requests delayed by --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = FakeGeminiServer((args.host, args.port), args.first_token_ms, args.token_ms, args.answer_tokens,
+                              args.error_rate, args.slow_rate, args.slow_ms, args.seed)
+    print(f"Fake Gemini listening on {server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Offline ingestion and query benchmark with synthetic PDFs and a local Gemini stand-in
+
+    python -m benchmarks.pipeline_benchmark --documents 20 --pages 10 --concurrency 1,8,32
+    python -m benchmarks.pipeline_benchmark --skip-ingestion --requests 500 --stream
+
+The ingestion phase generates PDFs (text-layer pages, every --scanned-every-th page an image of
+text), indexes them with textRAG.index_documents into a scratch index and reports pages/s,
+chunks/s and seconds per stage. The query phase starts the API with uvicorn on that index,
+with Gemini replaced by benchmarks/fake_gemini.py, and drives /query (or /query/stream) at each
+concurrency level, reporting p50/p95/p99 latency and QPS. Results go to --output as JSON,
+tagged with the git commit, so runs can be compared.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.extraction_benchmark import generate_mixed_corpus
+from benchmarks.fake_gemini import WORDS, FakeGeminiServer
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+INGESTION_STAGES = ("parse", "chunk", "embed", "vector_upsert")
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _latency_summary(seconds: List[float]) -> dict:
+    if not seconds:
+        return {}
+    return {"p50_ms": round(_percentile(seconds, 0.50) * 1000, 2),
+            "p95_ms": round(_percentile(seconds, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(seconds, 0.99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(seconds) * 1000, 2)}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _scratch_env(workdir: Path, backend: str) -> Dict[str, str]:
+    """Settings that keep the benchmark's index and caches out of the working tree"""
+    return {
+        "RAG_VECTOR_BACKEND": backend,
+        "RAG_NUMPY_INDEX_DIR": str(workdir / "numpy_index"),
+        "RAG_CHROMA_DIR": str(workdir / "chroma_db"),
+        "RAG_CHUNK_STORE_DIR": str(workdir / "chunk_store"),
+        "RAG_EMBEDDING_CACHE_PATH": str(workdir / "embedding_cache.sqlite"),
+        "RAG_SNAPSHOT_DIR": str(workdir / "no_snapshot"),
+    }
+
+
+def run_ingestion(corpus: Path) -> dict:
+    import pypdfium2 as pdfium
+
+    from metrics import STAGE_SECONDS
+    from textRAG import textRAG
+
+    files = sorted(corpus.glob("*.pdf"))
+    pages = 0
+    for path in files:
+        pdf = pdfium.PdfDocument(str(path))
+        pages += len(pdf)
+        pdf.close()
+
+    rag_pipeline = textRAG(folder_path=str(corpus), warm_up=False)
+    try:
+        # Model loading is start-up cost, not ingestion throughput
+        rag_pipeline.vector_store
+        rag_pipeline.chunker
+        before = STAGE_SECONDS.totals()
+        started = time.perf_counter()
+        chunks = rag_pipeline.index_documents(files, is_permanent=True)
+        seconds = time.perf_counter() - started
+        after = STAGE_SECONDS.totals()
+    finally:
+        rag_pipeline.close()
+
+    stage_seconds = {stage: round(after.get((stage,), (0.0, 0))[0] - before.get((stage,), (0.0, 0))[0], 3)
+                     for stage in INGESTION_STAGES}
+    return {"documents": len(files), "pages": pages, "chunks": len(chunks), "seconds": round(seconds, 3),
+            "pages_per_second": round(pages / seconds, 2), "chunks_per_second": round(len(chunks) / seconds, 2),
+            "stage_seconds": stage_seconds}
+
+
+def _question(i: int) -> str:
+    return f"What experience with {WORDS[i % len(WORDS)]} and {WORDS[(i * 7 + 3) % len(WORDS)]} is listed ({i})?"
+
+
+def _post(url: str, payload: dict, stream: bool, timeout: float,
+          deadline: Optional[float] = None) -> Tuple[Optional[float], bool]:
+    """Send one query; returns seconds to the first answer token when streaming, and whether the
+    API fell back to the retrieved context alone"""
+    headers = {"Content-Type": "application/json"}
+    if deadline:
+        headers["X-Request-Timeout"] = str(deadline)
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"), headers=headers)
+    started = time.perf_counter()
+    first_token = None
+    degraded = False
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if not stream:
+            return None, json.load(response).get("degraded", False)
+        for line in response:
+            if first_token is None and line.startswith(b"event: token"):
+                first_token = time.perf_counter() - started
+            if line.startswith(b"event: degraded"):
+                degraded = True
+            if line.startswith(b"event: error"):
+                # The next line is the event's data: {"detail": ...}
+                raise RuntimeError(next(response).decode("utf-8", "replace").strip())
+    return first_token, degraded
+
+
+def drive_queries(base_url: str, concurrency: int, requests: int, distinct: int, stream: bool,
+                  timeout: float, first_question: int = 0, deadline: Optional[float] = None) -> dict:
+    """Closed loop: concurrency clients each send their next query as soon as the last one returns"""
+    url = f"{base_url}/query/stream" if stream else f"{base_url}/query"
+    latencies: List[float] = []
+    first_tokens: List[float] = []
+    errors: Dict[str, int] = {}
+    degraded = 0
+    next_index = iter(range(requests))
+    lock = threading.Lock()
+
+    def client() -> None:
+        nonlocal degraded
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            try:
+                question = first_question + i
+                payload = {"query": _question(question % distinct if distinct else question)}
+                first_token, fell_back = _post(url, payload, stream, timeout, deadline)
+            except (urllib.error.URLError, OSError, RuntimeError) as e:
+                with lock:
+                    if isinstance(e, urllib.error.HTTPError):
+                        key = f"HTTP {e.code}"
+                    elif isinstance(e, RuntimeError):
+                        key = f"stream error {str(e)[:120]}"
+                    else:
+                        key = type(e).__name__
+                    errors[key] = errors.get(key, 0) + 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                degraded += fell_back
+                if first_token is not None:
+                    first_tokens.append(first_token)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    result = {"concurrency": concurrency, "requests": requests, "completed": len(latencies), "errors": errors,
+              "degraded": degraded, "wall_seconds": round(wall, 3), "qps": round(len(latencies) / wall, 2),
+              **_latency_summary(latencies)}
+    if first_tokens:
+        result["first_token"] = _latency_summary(first_tokens)
+    return result
+
+
+def _wait_ready(base_url: str, server: subprocess.Popen, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"API exited with code {server.returncode} during start-up")
+        try:
+            with urllib.request.urlopen(f"{base_url}/ready", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"API not ready after {timeout}s")
+
+
+def _fetch_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+def run_queries(args, env: Dict[str, str], workdir: Path) -> dict:
+    gemini = FakeGeminiServer(first_token_ms=args.llm_first_token_ms, token_ms=args.llm_token_ms,
+                              answer_tokens=args.llm_answer_tokens, error_rate=args.llm_error_rate,
+                              slow_rate=args.llm_slow_rate, slow_ms=args.llm_slow_ms).start()
+    base_url = f"http://127.0.0.1:{args.api_port}"
+    server_env = {**os.environ, **env, "RAG_GEMINI_ENDPOINT": gemini.endpoint,
+                  "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_ROOT), os.getenv("PYTHONPATH")]))}
+    log = open(workdir / "api.log", "w")
+    # Run from the scratch dir so the API's relative paths (pdfs/, caches) resolve there
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "api:app", "--port", str(args.api_port),
+                               "--log-level", "warning"], cwd=workdir, env=server_env, stdout=log,
+                              stderr=subprocess.STDOUT)
+    try:
+        _wait_ready(base_url, server, args.startup_timeout)
+        levels = []
+        for level, concurrency in enumerate(args.concurrency):
+            # Without --distinct-queries every level asks new questions, so answers are never cached
+            result = drive_queries(base_url, concurrency, args.requests, args.distinct_queries, args.stream,
+                                   args.request_timeout, first_question=level * args.requests,
+                                   deadline=args.deadline)
+            print(f"concurrency {concurrency}: {result['qps']} qps, p50 {result.get('p50_ms')}ms, "
+                  f"p95 {result.get('p95_ms')}ms, p99 {result.get('p99_ms')}ms, errors {result['errors']}, "
+                  f"degraded {result['degraded']}")
+            levels.append(result)
+        return {"endpoint": "/query/stream" if args.stream else "/query", "levels": levels,
+                "llm_requests": gemini.requests, "llm_failed": gemini.failed, "llm_slowed": gemini.slowed,
+                "server_stats": _fetch_json(f"{base_url}/stats")}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        log.close()
+        gemini.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10, help="Pages per generated PDF")
+    parser.add_argument("--scanned-every", type=int, default=0,
+                        help="Make every N-th page a scanned image (0: text-layer pages only)")
+    parser.add_argument("--backend", choices=("numpy", "chroma"), default="numpy")
+    parser.add_argument("--skip-ingestion", action="store_true", help="Query an empty index (resume not loaded)")
+    parser.add_argument("--skip-queries", action="store_true")
+    parser.add_argument("--concurrency", type=lambda value: [int(level) for level in value.split(",")],
+                        default=[1, 8, 32], help="Comma-separated client counts")
+    parser.add_argument("--requests", type=int, default=200, help="Queries per concurrency level")
+    parser.add_argument("--distinct-queries", type=int, default=0,
+                        help="Cycle through this many questions (0: every query distinct, so caches miss)")
+    parser.add_argument("--stream", action="store_true", help="Drive /query/stream and report time to first token")
+    parser.add_argument("--llm-first-token-ms", type=float, default=300.0)
+    parser.add_argument("--llm-token-ms", type=float, default=15.0)
+    parser.add_argument("--llm-answer-tokens", type=int, default=120)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of Gemini calls failing with 503")
+    parser.add_argument("--llm-slow-rate", type=float, default=0.0,
+                        help="Share of Gemini calls delayed by --llm-slow-ms")
+    parser.add_argument("--llm-slow-ms", type=float, default=0.0)
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Per-request deadline in seconds, sent as X-Request-Timeout")
+    parser.add_argument("--api-port", type=int, default=8799)
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--output", default="pipeline_benchmark.json")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="pipeline-bench-"))
+    env = _scratch_env(workdir, args.backend)
+    os.environ.update(env)
+    # textRAG requires a key; the stand-in server ignores it
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    report = {"commit": _git_commit(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "config": {key: value for key, value in vars(args).items() if key != "output"}}
+    try:
+        if not args.skip_ingestion:
+            corpus = workdir / "corpus"
+            generate_mixed_corpus(corpus, args.documents, pages=args.pages,
+                                  scanned_every=args.scanned_every or args.pages + 1)
+            report["ingestion"] = run_ingestion(corpus)
+            print(f"Ingestion: {report['ingestion']['pages_per_second']} pages/s, "
+                  f"{report['ingestion']['chunks_per_second']} chunks/s, "
+                  f"stage seconds {report['ingestion']['stage_seconds']}")
+        if not args.skip_queries:
+            report["query"] = run_queries(args, env, workdir)
+    finally:
+        if args.keep_workdir:
+            print(f"Scratch index kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Compare the NumPy vector store with Chroma on synthetic clustered embeddings
+
+    python -m benchmarks.vector_store_benchmark --rows 20000 --dim 1024 --output vector_store_benchmark.json
+
+Reports build time, p50/p95 single-query latency with the session filter the API uses,
+recall@k against brute force, and cold start (reopen the index and answer one query).
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from numpy_store import NumpyVectorStore
+
+
+def make_corpus(rows: int, dim: int, clusters: int, seed: int):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, rows)] + 0.5 * rng.normal(size=(rows, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"permanent:bench:{i}" for i in range(rows)]
+    texts = [f"chunk {i}" for i in range(rows)]
+    # A tenth of the rows are session uploads split across ten fingerprints
+    metadatas = [{"is_permanent": i % 10 != 0, "fingerprint": f"fp{i % 100}", "filename": f"doc{i % 50}.pdf"}
+                 for i in range(rows)]
+    queries = vectors[rng.integers(0, rows, 200)] + 0.05 * rng.normal(size=(200, dim)).astype(np.float32)
+    return vectors, ids, texts, metadatas, queries
+
+
+def session_filter() -> dict:
+    return {"$or": [{"is_permanent": True}, {"fingerprint": {"$in": ["fp0", "fp10"]}}]}
+
+
+def exact_top_k(vectors: np.ndarray, metadatas: List[dict], queries: np.ndarray, k: int) -> List[set]:
+    visible = np.array([m["is_permanent"] or m["fingerprint"] in ("fp0", "fp10") for m in metadatas])
+    rows = np.flatnonzero(visible)
+    normalized = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = vectors[rows] @ normalized.T
+    return [set(rows[np.argsort(-scores[:, column])[:k]].tolist()) for column in range(len(queries))]
+
+
+def latency(search: Callable[[np.ndarray], List[str]], queries: np.ndarray) -> Dict[str, float]:
+    timings = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": float(np.percentile(timings, 50)), "p95_ms": float(np.percentile(timings, 95)),
+            "results": results}
+
+
+def recall(results: List[List[str]], truth: List[set], k: int) -> float:
+    hits = [len({int(chunk_id.rsplit(":", 1)[1]) for chunk_id in found} & expected) / k
+            for found, expected in zip(results, truth)]
+    return float(np.mean(hits))
+
+
+def bench_numpy(directory: Path, corpus, k: int, dtype: str, ivf_min_rows: int, ivf_nprobe: int) -> dict:
+    # Vectors are always passed in directly; the embedding only has to match their dimension
+    vectors, ids, texts, metadatas, queries = corpus
+    options = {"dtype": dtype, "ivf_min_rows": ivf_min_rows, "ivf_nprobe": ivf_nprobe}
+    start = time.perf_counter()
+    store = NumpyVectorStore(DeterministicFakeEmbedding(size=vectors.shape[1]), str(directory), **options)
+    for batch in range(0, len(ids), 5000):
+        store.add_embeddings(texts[batch:batch + 5000], vectors[batch:batch + 5000],
+                             metadatas[batch:batch + 5000], ids=ids[batch:batch + 5000])
+    build_s = time.perf_counter() - start
+
+    def search(query: np.ndarray) -> List[str]:
+        return store.query_by_vectors([query], n_results=k, where=session_filter())["ids"][0]
+
+    search(queries[0])  # IVF partitions are trained by the first query once the index is large enough
+    measured = latency(search, queries)
+    store.close()
+
+    start = time.perf_counter()
+    reopened = NumpyVectorStore(DeterministicFakeEmbedding(size=vectors.shape[1]), str(directory), **options)
+    reopened.query_by_vectors([queries[0]], n_results=k, where=session_filter())
+    cold_start_s = time.perf_counter() - start
+    reopened.close()
+    return {"build_s": build_s, "cold_start_s": cold_start_s, **measured}
+
+
+def bench_chroma(directory: Path, corpus, k: int) -> dict:
+    vectors, ids, texts, metadatas, queries = corpus
+    start = time.perf_counter()
+    store = Chroma(collection_name="collection", embedding_function=DeterministicFakeEmbedding(size=vectors.shape[1]),
+                   persist_directory=str(directory))
+    for batch in range(0, len(ids), 5000):
+        store._collection.add(ids=ids[batch:batch + 5000], embeddings=vectors[batch:batch + 5000],
+                              documents=texts[batch:batch + 5000], metadatas=metadatas[batch:batch + 5000])
+    build_s = time.perf_counter() - start
+
+    def search(query: np.ndarray) -> List[str]:
+        return store._collection.query(query_embeddings=[query.tolist()], n_results=k, where=session_filter(),
+                                       include=["documents", "metadatas"])["ids"][0]
+
+    search(queries[0])
+    measured = latency(search, queries)
+    del store
+
+    start = time.perf_counter()
+    reopened = Chroma(collection_name="collection", embedding_function=DeterministicFakeEmbedding(size=vectors.shape[1]),
+                      persist_directory=str(directory))
+    reopened._collection.query(query_embeddings=[queries[0].tolist()], n_results=k, where=session_filter())
+    cold_start_s = time.perf_counter() - start
+    return {"build_s": build_s, "cold_start_s": cold_start_s, **measured}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--ivf-min-rows", type=int, default=50000)
+    parser.add_argument("--ivf-nprobe", type=int, default=8)
+    parser.add_argument("--skip-chroma", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="vector_store_benchmark.json")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.rows, args.dim, args.clusters, args.seed)
+    truth = exact_top_k(corpus[0], corpus[3], corpus[4], args.k)
+    workdir = Path(tempfile.mkdtemp(prefix="vector-bench-"))
+    report = {"config": vars(args), "backends": {}}
+    try:
+        backends = {"numpy": lambda: bench_numpy(workdir / "numpy", corpus, args.k, args.dtype,
+                                                 args.ivf_min_rows, args.ivf_nprobe)}
+        if not args.skip_chroma:
+            backends["chroma"] = lambda: bench_chroma(workdir / "chroma", corpus, args.k)
+        for name, run in backends.items():
+            result = run()
+            result[f"recall_at_{args.k}"] = recall(result.pop("results"), truth, args.k)
+            report["backends"][name] = result
+            print(f"{name:>6}: build {result['build_s']:.2f}s  p50 {result['p50_ms']:.2f}ms  "
+                  f"p95 {result['p95_ms']:.2f}ms  recall@{args.k} {result[f'recall_at_{args.k}']:.3f}  "
+                  f"cold start {result['cold_start_s']:.2f}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import re
+from dataclasses import asdict, dataclass
+from typing import List, Set
+
+from langchain_core.documents import Document
+
+SEPARATOR = "\n\n\n"
+SHINGLE_SIZE = 3
+# A truncated chunk is cut back to a sentence end only if that keeps at least this share of it
+MIN_SENTENCE_CUT = 0.5
+
+SENTENCE_BREAK = re.compile(r"[.!?]['\")\]]?(?=\s)|\n")
+
+
+@dataclass
+class PackedContext:
+    text: str
+    # Tokens of every retrieved chunk joined as is, and of the packed context sent to the LLM
+    retrieved_tokens: int
+    context_tokens: int
+    retrieved_chunks: int
+    context_chunks: int
+    duplicates_dropped: int = 0
+    truncated: bool = False
+
+    def token_counts(self) -> dict:
+        counts = asdict(self)
+        counts.pop("text")
+        return counts
+
+
+def _shingles(text: str) -> Set[tuple]:
+    words = text.lower().split()
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _truncate(tokenizer, text: str, max_tokens: int) -> str:
+    """Prefix of text within max_tokens, ending at a sentence boundary when one is close enough"""
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if len(offsets) <= max_tokens:
+        return text
+    prefix = text[:offsets[max_tokens - 1][1]]
+    breaks = [match.end() for match in SENTENCE_BREAK.finditer(prefix)]
+    if breaks and breaks[-1] >= MIN_SENTENCE_CUT * len(prefix):
+        return prefix[:breaks[-1]].rstrip()
+    # No sentence end nearby: at least do not split a word
+    space = prefix.rfind(" ")
+    return (prefix[:space] if space > 0 else prefix).rstrip()
+
+
+def pack_context(docs: List[Document], tokenizer, max_tokens: int = 2000, dedup_threshold: float = 0.8,
+                 min_truncate_tokens: int = 64) -> PackedContext:
+    """Join retrieved chunks, best first, into at most max_tokens tokens of context
+
+    A chunk is dropped when at least dedup_threshold of the smaller one's word 3-grams also appear
+    in a chunk already kept, which catches repeated uploads as well as overlapping windows. Chunks
+    that do not fit are skipped so a shorter one further down can still be used; the first one that
+    does not fit is cut to the remaining budget if at least min_truncate_tokens are left.
+    """
+    texts = [doc.page_content for doc in docs]
+    if not texts:
+        return PackedContext(text="", retrieved_tokens=0, context_tokens=0, retrieved_chunks=0, context_chunks=0)
+    lengths = [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    separator_tokens = len(tokenizer(SEPARATOR, add_special_tokens=False)["input_ids"])
+    retrieved_tokens = sum(lengths) + separator_tokens * (len(texts) - 1)
+
+    # docs arrive in retrieval order, which is relevance order
+    kept: List[int] = []
+    kept_shingles: List[Set[tuple]] = []
+    duplicates = 0
+    for i, text in enumerate(texts):
+        shingles = _shingles(text)
+        if any(len(shingles & other) >= dedup_threshold * min(len(shingles), len(other)) for other in kept_shingles):
+            duplicates += 1
+            continue
+        kept.append(i)
+        kept_shingles.append(shingles)
+
+    parts: List[str] = []
+    used = 0
+    truncated = False
+    for i in kept:
+        cost = lengths[i] + (separator_tokens if parts else 0)
+        if used + cost <= max_tokens:
+            parts.append(texts[i])
+            used += cost
+            continue
+        remaining = max_tokens - used - (separator_tokens if parts else 0)
+        if remaining > 0 and remaining >= min_truncate_tokens:
+            parts.append(_truncate(tokenizer, texts[i], remaining))
+            truncated = True
+            used = max_tokens
+            break
+
+    text = SEPARATOR.join(parts)
+    if truncated:
+        # The cut chunk's exact count can be a token or two under the budget
+        used = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+    return PackedContext(text=text, retrieved_tokens=retrieved_tokens, context_tokens=used,
+                         retrieved_chunks=len(texts), context_chunks=len(parts),
+                         duplicates_dropped=duplicates, truncated=truncated)
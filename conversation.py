@@ -0,0 +1,174 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Optional
+
+from context_packer import SENTENCE_BREAK
+
+# Folded turns keep the question and the answer's first sentence, each cut to this many characters
+SUMMARY_QUESTION_CHARS = 200
+SUMMARY_ANSWER_CHARS = 300
+
+# Phrasings that point back at an earlier question ("what about his Java?", "when was that?", "tell me
+# more about it"). Personal pronouns are left out: in a resume Q&A almost every question has a "he"
+FOLLOW_UP = re.compile(r"^(and|also|so|then|what about|how about|what else)\b"
+                       r"|\b(it|that|this|these|those|them)\W*$"
+                       r"|\b(the same|the above|the previous|the earlier|mentioned|more about|more on)\b",
+                       re.IGNORECASE)
+# Fragments like "Java?" or "and Kubernetes" only make sense after the previous question
+SHORT_QUESTION_WORDS = 2
+
+
+@dataclass
+class _Entry:
+    text: str
+    tokens: int
+    size: int
+
+
+@dataclass
+class _Turn:
+    question: str
+    answer: str
+    tokens: int
+    size: int
+
+
+@dataclass
+class _Conversation:
+    # Condensed older turns, oldest first, then the most recent turns verbatim
+    summary: Deque[_Entry] = field(default_factory=deque)
+    turns: Deque[_Turn] = field(default_factory=deque)
+    tokens: int = 0
+    size: int = 0
+    expires_at: float = 0.0
+
+
+def _condense(question: str, answer: str) -> str:
+    match = SENTENCE_BREAK.search(answer)
+    first_sentence = answer[:match.end()] if match else answer
+    return f"Q: {question.strip()[:SUMMARY_QUESTION_CHARS]} A: {first_sentence.strip()[:SUMMARY_ANSWER_CHARS]}"
+
+
+def rewrite_query(question: str, previous_question: Optional[str]) -> str:
+    """The question to retrieve with: a follow-up is prefixed with the question it follows"""
+    if not previous_question:
+        return question
+    if len(question.split()) > SHORT_QUESTION_WORDS and not FOLLOW_UP.search(question):
+        return question
+    return f"{previous_question.strip()} {question.strip()}"
+
+
+class ConversationStore:
+    """Per-session question/answer history with hard token and byte caps
+
+    The most recent turns are kept verbatim; once a session's history goes over max_tokens or
+    max_bytes the oldest turns are folded into a one-line extractive summary each (question and
+    the answer's first sentence), and the oldest summary lines are dropped after that. Sessions
+    are evicted least recently used first beyond max_sessions and expire after ttl_seconds idle,
+    so total memory stays under max_sessions * max_bytes however many sessions are opened.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], max_sessions: int = 5000, ttl_seconds: float = 1800.0,
+                 max_tokens: int = 1024, max_bytes: int = 16384):
+        self.count_tokens = count_tokens
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.summarized = 0
+        self.evicted = 0
+        self.expired = 0
+        self._sessions: "OrderedDict[str, _Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, text: str) -> _Entry:
+        return _Entry(text=text, tokens=self.count_tokens(text), size=len(text.encode("utf-8")))
+
+    def _expire(self, now: float) -> None:
+        # Sessions are kept in last-used order, so the expired ones are at the front
+        while self._sessions:
+            session_id, conversation = next(iter(self._sessions.items()))
+            if conversation.expires_at > now:
+                return
+            del self._sessions[session_id]
+            self.expired += 1
+
+    def _get(self, session_id: str) -> Optional[_Conversation]:
+        now = time.monotonic()
+        self._expire(now)
+        conversation = self._sessions.get(session_id)
+        if conversation is not None:
+            conversation.expires_at = now + self.ttl_seconds
+            self._sessions.move_to_end(session_id)
+        return conversation
+
+    def last_question(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            conversation = self._get(session_id)
+            return conversation.turns[-1].question if conversation and conversation.turns else None
+
+    def render(self, session_id: str) -> str:
+        """The history as prompt text, or an empty string for a new session"""
+        with self._lock:
+            conversation = self._get(session_id)
+            if conversation is None:
+                return ""
+            lines = []
+            if conversation.summary:
+                lines.append("Earlier (condensed):")
+                lines += [f"- {entry.text}" for entry in conversation.summary]
+            for turn in conversation.turns:
+                lines += [f"User: {turn.question}", f"Assistant: {turn.answer}"]
+            return "\n".join(lines)
+
+    def append(self, session_id: str, question: str, answer: str) -> None:
+        counted = self._entry(f"{question}\n{answer}")
+        turn = _Turn(question=question, answer=answer, tokens=counted.tokens, size=counted.size)
+        with self._lock:
+            conversation = self._get(session_id)
+            if conversation is None:
+                conversation = self._sessions[session_id] = _Conversation(
+                    expires_at=time.monotonic() + self.ttl_seconds)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted += 1
+            conversation.turns.append(turn)
+            conversation.tokens += turn.tokens
+            conversation.size += turn.size
+            self._shrink(conversation)
+
+    def _shrink(self, conversation: _Conversation) -> None:
+        while conversation.tokens > self.max_tokens or conversation.size > self.max_bytes:
+            # Condense old turns first, keeping the latest verbatim as long as older lines can go instead
+            if len(conversation.turns) > 1 or (conversation.turns and not conversation.summary):
+                turn = conversation.turns.popleft()
+                line = self._entry(_condense(turn.question, turn.answer))
+                conversation.summary.append(line)
+                conversation.tokens += line.tokens - turn.tokens
+                conversation.size += line.size - turn.size
+                self.summarized += 1
+            elif conversation.summary:
+                line = conversation.summary.popleft()
+                conversation.tokens -= line.tokens
+                conversation.size -= line.size
+            else:
+                return
+
+    def drop(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "bytes": sum(conversation.size for conversation in self._sessions.values()),
+                "summarized": self.summarized,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
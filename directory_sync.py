@@ -0,0 +1,198 @@
+"""Incremental sync of the documents folder into the permanent index
+
+A manifest records each file's size, mtime, content hash and chunk count. A run only hashes
+files whose size or mtime changed, parses new or changed content in a pool of worker
+processes, and deletes the chunks of files that were removed or replaced.
+
+    python directory_sync.py --folder pdfs --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from langchain_core.documents import Document
+
+from ingestion import TierStats, _init_worker, observe_stages, parse_and_chunk
+
+MANIFEST_VERSION = 1
+CHECKPOINT_EVERY = 25
+
+
+def load_manifest(manifest_path: Path) -> Dict[str, dict]:
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["files"]
+
+
+def save_manifest(manifest_path: Path, files: Dict[str, dict]) -> None:
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def _drain(progress_queue) -> None:
+    # Workers report parse stages for the upload queue; nothing reads them here
+    while progress_queue.get() is not None:
+        pass
+
+
+def sync_directory(rag_pipeline, manifest_path: str = "./sync_manifest.json", workers: int = 4,
+                   rehash: bool = False) -> dict:
+    """Bring the permanent index in line with rag_pipeline.folder_path; returns per-category file counts"""
+    started = time.time()
+    manifest_path = Path(manifest_path)
+    previous = load_manifest(manifest_path)
+    current: Dict[str, dict] = {}
+
+    # Unchanged size and mtime means unchanged content, unless a full rehash is requested
+    to_hash: List[tuple] = []
+    for path in rag_pipeline.find_documents():
+        key = str(path)
+        stat = path.stat()
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        old = previous.get(key)
+        if old and not rehash and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"]:
+            current[key] = dict(old)
+        else:
+            to_hash.append((key, path, entry))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (key, path, entry), fingerprint in zip(to_hash, pool.map(rag_pipeline.fingerprint_file,
+                                                                    [path for _, path, _ in to_hash])):
+            current[key] = {**entry, "fingerprint": fingerprint, "chunks": None, "source": key}
+
+    summary = {"unchanged": 0, "added": 0, "changed": 0, "removed": 0, "failed": 0}
+    # Identical files share one set of chunks, attributed to the path recorded as their source
+    indexed = {entry["fingerprint"]: entry for entry in previous.values() if entry["source"] in current}
+    pending: Dict[str, List[str]] = {}  # fingerprint -> paths waiting for it to be indexed
+    for key, entry in current.items():
+        old = previous.get(key)
+        if old is not None and old["fingerprint"] == entry["fingerprint"]:
+            summary["unchanged"] += 1
+        else:
+            summary["changed" if old is not None else "added"] += 1
+        if entry["fingerprint"] in indexed:
+            entry["chunks"] = indexed[entry["fingerprint"]]["chunks"]
+            entry["source"] = indexed[entry["fingerprint"]]["source"]
+        else:
+            # New content, or its source file is gone and the chunks need a new attribution
+            entry["chunks"] = None
+            pending.setdefault(entry["fingerprint"], []).append(key)
+    summary["removed"] = sum(1 for key in previous if key not in current)
+
+    # Chunks are keyed by content hash, so they go only when no remaining file has those bytes
+    live = {entry["fingerprint"] for entry in current.values()}
+    stale_ids = [rag_pipeline.chunk_id(entry["fingerprint"], position)
+                 for entry in {old["fingerprint"]: old for old in previous.values()}.values()
+                 if entry["fingerprint"] not in live
+                 for position in range(entry["chunks"] or 0)]
+    if stale_ids:
+        rag_pipeline.delete_chunks(stale_ids)
+
+    files = {key: entry for key, entry in current.items() if entry["chunks"] is not None}
+    if pending:
+        previous_chunks = {entry["fingerprint"]: entry["chunks"] for entry in previous.values()}
+        _index_pending(rag_pipeline, pending, previous_chunks, current, files, manifest_path, workers, summary)
+    save_manifest(manifest_path, files)
+
+    summary["chunks_deleted"] = len(stale_ids)
+    summary["seconds"] = round(time.time() - started, 2)
+    return summary
+
+
+def _parsed_documents(rag_pipeline, pending: Dict[str, List[str]], workers: int,
+                      tier_stats: TierStats) -> Iterator[tuple]:
+    """Yield (fingerprint, chunk texts, from chunk store, error) as each pending document becomes available"""
+    to_parse = []
+    for fingerprint in pending:
+        cached = rag_pipeline.load_cached_chunks(fingerprint)
+        if cached is None:
+            to_parse.append(fingerprint)
+        else:
+            yield fingerprint, [doc.page_content for doc in cached], True, None
+    if not to_parse:
+        return
+
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    threading.Thread(target=_drain, args=(progress_queue,), daemon=True).start()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(progress_queue, rag_pipeline.embedding_model_name)) as pool:
+            futures = {pool.submit(parse_and_chunk, fingerprint, pending[fingerprint][0],
+                                   **rag_pipeline.extraction_options()): fingerprint
+                       for fingerprint in to_parse}
+            for future in as_completed(futures):
+                try:
+                    chunks, timings = future.result()
+                except Exception as e:
+                    yield futures[future], None, False, e
+                    continue
+                tier_stats.merge(timings)
+                observe_stages(timings["stages"])
+                yield futures[future], [chunk["page_content"] for chunk in chunks], False, None
+    finally:
+        progress_queue.put(None)
+
+
+def _index_pending(rag_pipeline, pending: Dict[str, List[str]], previous_chunks: Dict[str, int],
+                   current: Dict[str, dict], files: Dict[str, dict], manifest_path: Path, workers: int,
+                   summary: dict) -> None:
+    # Workers keep parsing while finished documents are embedded and indexed here
+    tier_stats = TierStats()
+    parsed = _parsed_documents(rag_pipeline, pending, workers, tier_stats)
+    for done, (fingerprint, texts, from_store, error) in enumerate(parsed, start=1):
+        keys = pending[fingerprint]
+        if error is not None:
+            # Left out of the manifest, so the next run retries it
+            summary["failed"] += len(keys)
+            print(f"Failed to index {keys[0]}: {error}")
+            continue
+        chunks = [Document(page_content=text,
+                           metadata={"source": keys[0], "filename": Path(keys[0]).name, "fingerprint": fingerprint})
+                  for text in texts]
+        if not from_store:
+            rag_pipeline.save_cached_chunks(fingerprint, chunks)
+        rag_pipeline.index_chunks(chunks, is_permanent=True, session_id=None)
+        leftover = range(len(chunks), previous_chunks.get(fingerprint, 0))
+        if leftover:
+            rag_pipeline.delete_chunks([rag_pipeline.chunk_id(fingerprint, position) for position in leftover])
+        for key in keys:
+            current[key].update(chunks=len(chunks), source=keys[0])
+            files[key] = current[key]
+        if done % CHECKPOINT_EVERY == 0:
+            save_manifest(manifest_path, files)
+            print(f"Indexed {done}/{len(pending)} new or changed documents")
+    # Worker-side extraction time summed over documents, per tier
+    summary["extraction"] = tier_stats.to_dict()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Index new or changed documents and drop removed ones")
+    parser.add_argument("--folder", default="pdfs")
+    parser.add_argument("--manifest", default=os.getenv("RAG_SYNC_MANIFEST", "./sync_manifest.json"))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("RAG_SYNC_WORKERS", "4")))
+    parser.add_argument("--rehash", action="store_true", help="Hash every file instead of trusting size and mtime")
+    args = parser.parse_args()
+
+    from textRAG import textRAG
+
+    # Models and the vector store load lazily, so an unchanged folder never touches them
+    rag_pipeline = textRAG(folder_path=args.folder, warm_up=False)
+    summary = sync_directory(rag_pipeline, args.manifest, workers=args.workers, rehash=args.rehash)
+    print(json.dumps(summary))
+    rag_pipeline.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+
+class EmbeddingCache:
+    """Content-addressed on-disk store of embedding vectors with LRU eviction
+
+    Lookups only read: last-used times of hits are collected in memory and written in one
+    batch at most every touch_interval seconds (and before an eviction), and the row count is
+    tracked in memory, so the query path does not wait on SQLite writes.
+    """
+
+    def __init__(self, path: str, model_name: str, max_entries: int = 200_000, touch_interval: float = 30.0):
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def key(self, text: str, kind: str = "document") -> str:
+        # Queries and documents may be encoded differently, so they live in separate namespaces
+        return hashlib.sha256(f"{self.model_name}\x00{kind}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: List[str], kind: str = "document") -> List[Optional[List[float]]]:
+        keys = [self.key(text, kind) for text in texts]
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            now = time.time()
+            for key in found:
+                self._touched[key] = now
+            if self._touched and time.monotonic() - self._last_flush >= self.touch_interval:
+                self._flush_touches()
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return [found.get(key) for key in keys]
+
+    def _flush_touches(self) -> None:
+        # Caller holds self._lock
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                   [(last_used, key) for key, last_used in self._touched.items()])
+            self._conn.commit()
+            self._touched.clear()
+        self._last_flush = time.monotonic()
+
+    def put_many(self, texts: List[str], vectors: List[List[float]], kind: str = "document") -> None:
+        now = time.time()
+        rows = [(self.key(text, kind), array("f", vector).tobytes(), now) for text, vector in zip(texts, vectors)]
+        with self._lock:
+            # Keys are content hashes, so an existing row already holds the same vector; only the
+            # rows actually inserted change the count
+            changes = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            inserted = self._conn.total_changes - changes
+            self._size += inserted
+            if inserted < len(rows):
+                for key, _, _ in rows:
+                    self._touched[key] = now
+            overflow = self._size - self.max_entries
+            if overflow > 0:
+                # Evict by up-to-date last-used times
+                self._flush_touches()
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (overflow,)
+                )
+                self.evictions += overflow
+                self._size -= overflow
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches()
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends texts missing from the cache to the model"""
+
+    def __init__(self, underlying: Embeddings, cache: EmbeddingCache):
+        self.underlying = underlying
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(texts, kind="document")
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, self.underlying.embed_documents(missing)))
+            self.cache.put_many(missing, [computed[text] for text in missing], kind="document")
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(texts, kind="query")
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            # GIST is used without a query instruction, so one document batch embeds all queries at once
+            computed = dict(zip(missing, self.underlying.embed_documents(missing)))
+            self.cache.put_many(missing, [computed[text] for text in missing], kind="query")
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.cache.get_many([text], kind="query")[0]
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self.cache.put_many([text], [vector], kind="query")
+        return vector
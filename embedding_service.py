@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    """Embeddings wrapper that runs concurrent embed_query calls as one batched forward pass
+
+    The first query starts a window of at most max_wait_ms; queries arriving within it (up to
+    max_batch_size) are embedded together and the vectors are handed back to each caller.
+    """
+
+    def __init__(self, underlying: Embeddings, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.underlying = underlying
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        future: Future = Future()
+        with self._close_lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put((text, future))
+        if closed:
+            return self.underlying.embed_query(text)
+        return future.result()
+
+    def _collect(self) -> list:
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch before shutting down
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _drain(self) -> list:
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch
+            if item is not None:
+                batch.append(item)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if not batch:
+                # Shutting down: whatever is still queued is embedded in one last batch
+                self._embed(self._drain())
+                return
+            self._embed(batch)
+
+    def _embed(self, batch: list) -> None:
+        if not batch:
+            return
+        texts = [text for text, _ in batch]
+        try:
+            # GIST is used without a query instruction, so queries embed like a document batch
+            vectors = self.underlying.embed_documents(texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+    def close(self) -> None:
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
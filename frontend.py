@@ -5,8 +5,10 @@ from pathlib import Path
 import os
 import atexit
 import time
+import uuid
 
 API_URL = "http://localhost:8000"
+MAX_UPLOAD_MB = int(os.getenv("RAG_MAX_UPLOAD_MB", "50"))
 
 # Set page configuration
 st.set_page_config(
@@ -27,11 +29,13 @@ if 'api_last_checked' not in st.session_state:
     st.session_state.api_last_checked = 0
 if 'loaded_docs_cache' not in st.session_state:
     st.session_state.loaded_docs_cache = None
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
-def cleanup_session():
+def cleanup_session(session_id):
     """Clean up session documents on app close"""
     try:
-        response = requests.post(f"{API_URL}/cleanup-session")
+        response = requests.post(f"{API_URL}/cleanup-session", params={"session_id": session_id})
         return response.status_code == 200
     except:
         return False
@@ -39,14 +43,14 @@ def cleanup_session():
 # App title and description
 st.title("📚 RAG Document Assistant")
 st.markdown("Ask questions about documents! ManishKumar's resume is always available, and you can upload additional PDFs for your session.")
-st.markdown("*Disclaimer: This is a demo application with limited functionality. There is no chat history implemented due to memeory constraints, hence each question is independent of previous ones.  Please note that uploading a 4-page PDF may take 1–2 minutes to process.*")
+st.markdown("*Disclaimer: This is a demo application with limited functionality. Your recent questions are remembered so follow-ups like 'what about his Java?' work; older ones are condensed to a line each to bound memory, and the history is forgotten after 30 minutes idle.  Please note that uploading a 4-page PDF may take 1–2 minutes to process.*")
 
 
 st.sidebar.title("Settings")
 
 # Cleanup on session end
 if not st.session_state.session_cleaned:
-    atexit.register(cleanup_session)
+    atexit.register(cleanup_session, st.session_state.session_id)
 
 def check_api_health():
     try:
@@ -55,24 +59,53 @@ def check_api_health():
     except:
         return False
     
-def query_api(question):
+def stream_query_api(question, result):
+    """Yield answer tokens from the SSE endpoint and store the sources in result"""
     try:
-        response = requests.post(f"{API_URL}/query", json={"query": question})
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"Error: {response.status_code} - {response.text}")
-            return None
+        with requests.post(f"{API_URL}/query/stream", json={"query": question, "session_id": st.session_state.session_id},
+                           stream=True) as response:
+            if response.status_code != 200:
+                st.error(f"Error: {response.status_code} - {response.text}")
+                return
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "sources":
+                        result["source_documents"] = data["source_documents"]
+                        result["retrieval_query"] = data.get("retrieval_query")
+                    elif event == "token":
+                        yield data["text"]
+                    elif event == "degraded":
+                        result["degraded"] = True
+                        st.warning("The answer service is unavailable right now; "
+                                   "see the source context for the most relevant passages.")
+                    elif event == "error":
+                        st.error(f"Error: {data['detail']}")
     except Exception as e:
         st.error(f"Exception occurred: {str(e)}")
-        return None
 
-def upload_file(file_bytes, filename):
+def upload_file(uploaded_file):
+    if uploaded_file.size > MAX_UPLOAD_MB * 1024 * 1024:
+        st.error(f"{uploaded_file.name} is larger than the {MAX_UPLOAD_MB} MB upload limit.")
+        return None
     try:
-        files = {'file': (filename, file_bytes, 'application/pdf')}
-        response = requests.post(f"{API_URL}/upload", files=files)
-        if response.status_code == 200:
+        # The file object is passed as is, so its bytes are not copied into another buffer first
+        uploaded_file.seek(0)
+        files = {'file': (uploaded_file.name, uploaded_file, 'application/pdf')}
+        data = {'session_id': st.session_state.session_id}
+        response = requests.post(f"{API_URL}/upload", files=files, data=data)
+        if response.status_code in (200, 202):
             return response.json()
+        elif response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "a few")
+            st.error(f"The server is busy indexing other uploads. Please retry in {retry_after} seconds.")
+            return None
+        elif response.status_code == 413:
+            st.error(response.json().get("detail", "File is too large"))
+            return None
         else:
             st.error(f"Error uploading file: {response.status_code} - {response.text}")
             return None
@@ -80,6 +113,23 @@ def upload_file(file_bytes, filename):
         st.error(f"Exception occurred during upload: {str(e)}")
         return None
 
+def wait_for_job(job_id, progress_bar, poll_interval=1.0):
+    """Poll the ingestion job until it is indexed or failed"""
+    while True:
+        try:
+            response = requests.get(f"{API_URL}/jobs/{job_id}")
+        except Exception as e:
+            st.error(f"Exception occurred while checking upload status: {str(e)}")
+            return None
+        if response.status_code != 200:
+            st.error(f"Error checking upload status: {response.status_code} - {response.text}")
+            return None
+        job = response.json()
+        progress_bar.progress(job["progress"], text=f"{job['filename']}: {job['stage']}")
+        if job["stage"] in ("indexed", "failed"):
+            return job
+        time.sleep(poll_interval)
+
 def loaded_docs():
     try:
         response = requests.get(f"{API_URL}/loadedpdfs")
@@ -143,8 +193,13 @@ uploaded_file = st.sidebar.file_uploader(
 if uploaded_file is not None:
     if uploaded_file.name not in st.session_state.uploaded_files:
         with st.spinner(f"Uploading and processing {uploaded_file.name}..."):
-            file_bytes = uploaded_file.read()
-            result = upload_file(file_bytes, uploaded_file.name)
+            result = upload_file(uploaded_file)
+            if result and result.get('job_id'):
+                job = wait_for_job(result['job_id'], st.sidebar.progress(0.0))
+                if not job or job['stage'] != 'indexed':
+                    if job and job.get('error'):
+                        st.sidebar.error(job['error'])
+                    result = None
             
             if result and result.get('success'):
                 st.session_state.uploaded_files.append(uploaded_file.name)
@@ -156,7 +211,7 @@ if uploaded_file is not None:
 if st.session_state.uploaded_files:
     if st.sidebar.button("Clear Session Documents"):
         with st.spinner("Cleaning up session documents..."):
-            if cleanup_session():
+            if cleanup_session(st.session_state.session_id):
                 st.session_state.uploaded_files = []
                 st.session_state.session_cleaned = True
                 st.sidebar.success("Session documents cleared!")
@@ -179,14 +234,15 @@ with col2:
 
 if submit_button:
     if question and st.session_state.api_status:
-        with st.spinner("Thinking..."):
-            result = query_api(question)
-            if result:
-                st.subheader("Answer")
-                st.write(result["answer"])
-                
-                with st.expander("Source Context"):
-                    st.text(result["source_documents"])
+        result = {}
+        st.subheader("Answer")
+        st.write_stream(stream_query_api(question, result))
+        if result.get("retrieval_query") not in (None, question):
+            st.caption(f"Searched as a follow-up: {result['retrieval_query']}")
+
+        if result.get("source_documents") is not None:
+            with st.expander("Source Context", expanded=result.get("degraded", False)):
+                st.text(result["source_documents"])
     else:
         if not st.session_state.api_status:
             st.error("API is not running. Please start the API server.")
@@ -0,0 +1,466 @@
+import hashlib
+import multiprocessing
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from metrics import STAGE_SECONDS
+from tiered_extraction import convert_task, plan_tasks
+
+
+JOB_STAGES = ("queued", "parsing", "chunking", "embedding", "indexed", "failed")
+
+# Progress reported when a job enters each stage; embedding advances towards 1.0 per batch
+STAGE_PROGRESS = {"queued": 0.0, "parsing": 0.05, "chunking": 0.5, "embedding": 0.6, "indexed": 1.0}
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Ingestion queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobCancelledError(Exception):
+    def __init__(self):
+        super().__init__("Cancelled: every session that uploaded the document was cleaned up")
+
+
+class UploadTooLargeError(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit")
+        self.max_bytes = max_bytes
+
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadSpool:
+    """Writes an upload into its own temp directory block by block, hashing it on the way
+
+    Only one block is held in memory, whatever the file size. The directory is handed on to
+    the ingestion queue (which removes it when the job ends) or dropped with discard().
+    """
+
+    def __init__(self, filename: str, max_bytes: Optional[int] = None, spool_dir: Optional[str] = None):
+        self.directory = Path(tempfile.mkdtemp(prefix="rag-upload-", dir=spool_dir))
+        # Only the base name: the client controls filename
+        self.path = self.directory / Path(filename).name
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = open(self.path, "wb")
+
+    def write(self, block: bytes) -> None:
+        self.size += len(block)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise UploadTooLargeError(self.max_bytes)
+        self._digest.update(block)
+        self._file.write(block)
+
+    def finish(self) -> str:
+        """Close the file and return its fingerprint (sha256 of the content, as textRAG.fingerprint)"""
+        self._file.close()
+        return self._digest.hexdigest()
+
+    def discard(self) -> None:
+        self._file.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @classmethod
+    def from_file(cls, source: BinaryIO, filename: str, max_bytes: Optional[int] = None,
+                  spool_dir: Optional[str] = None) -> Tuple["UploadSpool", str]:
+        spool = cls(filename, max_bytes=max_bytes, spool_dir=spool_dir)
+        try:
+            for block in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+                spool.write(block)
+            return spool, spool.finish()
+        except BaseException:
+            spool.discard()
+            raise
+
+
+class MultipartUpload:
+    """Parses a multipart/form-data body fed to it piece by piece, spooling the file part to disk
+
+    The file part goes straight into an UploadSpool as it is parsed, so the upload is stored once,
+    on disk, and never held whole in memory; other form fields (up to max_field_bytes) are kept
+    in fields. Only one file per body is accepted.
+    """
+
+    def __init__(self, content_type: str, max_bytes: Optional[int] = None, spool_dir: Optional[str] = None,
+                 max_field_bytes: int = 4096):
+        mime_type, options = parse_options_header(content_type)
+        if mime_type != b"multipart/form-data" or not options.get(b"boundary"):
+            raise ValueError("Expected a multipart/form-data body")
+        self.max_bytes = max_bytes
+        self.spool_dir = spool_dir
+        self.max_field_bytes = max_field_bytes
+        self.fields: Dict[str, str] = {}
+        self.filename: Optional[str] = None
+        self.spool: Optional[UploadSpool] = None
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._name = ""
+        self._value = bytearray()
+        self._in_file = False
+        self._parser = MultipartParser(options[b"boundary"], callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+        self._value = bytearray()
+        self._in_file = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" not in options:
+            return
+        if self.spool is not None:
+            raise ValueError("Only one file per upload")
+        self.filename = options[b"filename"].decode("utf-8", "replace")
+        self.spool = UploadSpool(self.filename, max_bytes=self.max_bytes, spool_dir=self.spool_dir)
+        self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self.spool.write(data[start:end])
+            return
+        self._value += data[start:end]
+        if len(self._value) > self.max_field_bytes:
+            raise ValueError(f"Form field {self._name} is too large")
+
+    def _on_part_end(self) -> None:
+        if not self._in_file:
+            self.fields[self._name] = self._value.decode("utf-8", "replace")
+
+    def write(self, data: bytes) -> None:
+        self._parser.write(data)
+
+    def finish(self) -> str:
+        """End of the body; returns the file's fingerprint"""
+        self._parser.finalize()
+        if self.spool is None:
+            raise ValueError("No file in the upload")
+        return self.spool.finish()
+
+    def discard(self) -> None:
+        if self.spool is not None:
+            self.spool.discard()
+
+
+@dataclass
+class IngestionJob:
+    job_id: str
+    filename: str
+    fingerprint: str
+    stage: str = "queued"
+    progress: float = 0.0
+    chunk_count: int = 0
+    error: Optional[str] = None
+    # Seconds and pages per extraction tier ("text" layer or full "docling"), plus "classify" seconds
+    tier_seconds: Dict[str, float] = field(default_factory=dict)
+    tier_pages: Dict[str, int] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# State owned by each worker process, set up once by _init_worker
+_worker_converter = None
+_worker_chunker = None
+_worker_progress = None
+
+
+def _init_worker(progress_queue, model_name: str) -> None:
+    global _worker_converter, _worker_chunker, _worker_progress
+    from docling.chunking import HybridChunker
+    from docling.document_converter import DocumentConverter
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    _worker_chunker = HybridChunker(tokenizer=tokenizer, max_chunk_size=tokenizer.model_max_length, merge_peers=True)
+    _worker_converter = DocumentConverter()
+    _worker_progress = progress_queue
+
+
+class TierStats:
+    """Extraction seconds and page counts per tier, and seconds per stage (parse, chunk), for one document"""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.pages: Dict[str, int] = {}
+        self.stages: Dict[str, float] = {}
+
+    def add(self, task: tuple, timings: Dict[str, float]) -> None:
+        tier, first_page, last_page = task
+        self.seconds[tier] = self.seconds.get(tier, 0.0) + sum(timings.values())
+        if first_page is not None:
+            self.pages[tier] = self.pages.get(tier, 0) + last_page - first_page + 1
+        for stage, seconds in timings.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def merge(self, other: dict) -> None:
+        for tier, seconds in other["seconds"].items():
+            self.seconds[tier] = self.seconds.get(tier, 0.0) + seconds
+        for tier, pages in other["pages"].items():
+            self.pages[tier] = self.pages.get(tier, 0) + pages
+        for stage, seconds in other.get("stages", {}).items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        return {"seconds": {tier: round(seconds, 3) for tier, seconds in self.seconds.items()},
+                "pages": dict(self.pages),
+                "stages": {stage: round(seconds, 3) for stage, seconds in self.stages.items()}}
+
+
+def observe_stages(stages: Dict[str, float]) -> None:
+    """Record one document's parse and chunk seconds, measured in a worker, in the stage histogram"""
+    for stage, seconds in stages.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def convert_pages(job_id: str, file_path: str, tier: str, first_page: Optional[int],
+                  last_page: Optional[int]) -> Tuple[List[str], Dict[str, float]]:
+    """Extract and chunk one planned page run inside a worker process; returns (chunk texts, stage seconds)"""
+    _worker_progress.put((job_id, "parsing"))
+    timings: Dict[str, float] = {}
+    texts = convert_task(file_path, tier, first_page, last_page, _worker_chunker, converter=_worker_converter,
+                         timings=timings, on_parsed=lambda: _worker_progress.put((job_id, "chunking")))
+    return texts, timings
+
+
+def parse_and_chunk(job_id: str, file_path: str, fast_path: bool = True, min_chars: int = 200,
+                    pages_per_task: int = 4) -> Tuple[List[dict], dict]:
+    """Convert and chunk a whole file inside one worker process; returns (chunks, tier timings)"""
+    stats = TierStats()
+    started = time.time()
+    tasks = plan_tasks(file_path, fast_path=fast_path, min_chars=min_chars, pages_per_task=pages_per_task)
+    stats.seconds["classify"] = time.time() - started
+    chunks = []
+    for task in tasks:
+        texts, timings = convert_pages(job_id, file_path, *task)
+        stats.add(task, timings)
+        chunks.extend({"page_content": text, "metadata": {"source": file_path, "filename": Path(file_path).name}}
+                      for text in texts)
+    return chunks, stats.to_dict()
+
+
+class IngestionQueue:
+    """Bounded queue of upload jobs, parsed in a process pool and indexed by the RAG pipeline"""
+
+    def __init__(self, rag_pipeline, workers: int = 2, max_depth: int = 16, max_jobs_kept: int = 1000):
+        self.rag_pipeline = rag_pipeline
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_jobs_kept = max_jobs_kept
+        self.jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._inflight: Dict[str, IngestionJob] = {}  # fingerprint -> job still being processed
+        self._job_sessions: Dict[str, set] = {}  # job id -> sessions waiting for the document
+        self._active = 0
+        self._avg_job_seconds = 30.0
+        self._lock = threading.Lock()
+        # Embedding runs in this process, so only one job embeds at a time to leave CPU for queries
+        self._embedding_slot = threading.Semaphore(1)
+
+        # Spawned (not forked) workers, since the parent already holds torch and its threads
+        context = multiprocessing.get_context("spawn")
+        self._progress = context.Queue()
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self._progress, rag_pipeline.embedding_model_name),
+        )
+        self._pending: "queue.Queue" = queue.Queue()
+
+        self._threads = [threading.Thread(target=self._progress_loop, name="ingest-progress", daemon=True)]
+        self._threads += [threading.Thread(target=self._dispatch_loop, name=f"ingest-dispatch-{i}", daemon=True)
+                          for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, file_path: Path, filename: str, fingerprint: str, session_id: str) -> IngestionJob:
+        """Queue a spooled upload; the queue owns file_path's directory from here and removes it"""
+        with self._lock:
+            # Identical bytes already being processed: report that job instead of parsing twice
+            if fingerprint in self._inflight:
+                job = self._inflight[fingerprint]
+                self._job_sessions[job.job_id].add(session_id)
+                shutil.rmtree(file_path.parent, ignore_errors=True)
+                return job
+            if self._active >= self.max_depth:
+                shutil.rmtree(file_path.parent, ignore_errors=True)
+                raise QueueFullError(self.retry_after())
+            self._active += 1
+            job = IngestionJob(job_id=uuid.uuid4().hex, filename=filename, fingerprint=fingerprint)
+            self._inflight[fingerprint] = job
+            self._job_sessions[job.job_id] = {session_id}
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.max_jobs_kept:
+                self.jobs.popitem(last=False)
+
+        self._pending.put((job, file_path))
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self.jobs.get(job_id)
+
+    def cancel_session(self, session_id: str) -> None:
+        """Stop a cleaned-up session's pending jobs from linking the document to it
+
+        Call before removing the session's documents: a job finishing at the same moment links
+        while holding the lock, so it either links first (and the cleanup removes it) or not at
+        all. A job left with no session is dropped before embedding, or its chunks are deleted.
+        """
+        with self._lock:
+            for sessions in self._job_sessions.values():
+                sessions.discard(session_id)
+
+    def _check_cancelled(self, job: IngestionJob) -> None:
+        with self._lock:
+            if not self._job_sessions.get(job.job_id):
+                raise JobCancelledError()
+
+    def full(self) -> bool:
+        return self._active >= self.max_depth
+
+    def retry_after(self) -> int:
+        return max(1, int(self._avg_job_seconds * max(self._active, 1) / self.workers))
+
+    def stats(self) -> dict:
+        return {"active": self._active, "max_depth": self.max_depth, "workers": self.workers}
+
+    def _update(self, job: IngestionJob, stage: str, progress: Optional[float] = None) -> None:
+        job.stage = stage
+        job.progress = STAGE_PROGRESS.get(stage, job.progress) if progress is None else progress
+        job.updated_at = time.time()
+
+    def _progress_loop(self) -> None:
+        while True:
+            message = self._progress.get()
+            if message is None:
+                return
+            job_id, stage = message
+            job = self.jobs.get(job_id)
+            # Messages can arrive after the dispatcher has moved the job on; never go backwards
+            if job is not None and JOB_STAGES.index(stage) > JOB_STAGES.index(job.stage):
+                self._update(job, stage)
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            job, file_path = item
+            started = time.time()
+            try:
+                self._run(job, file_path)
+            except Exception as e:
+                job.error = str(e)
+                self._update(job, "failed", progress=job.progress)
+                print(f"Ingestion job {job.job_id} ({job.filename}) failed: {e}")
+            finally:
+                shutil.rmtree(file_path.parent, ignore_errors=True)
+                with self._lock:
+                    self._active -= 1
+                    self._inflight.pop(job.fingerprint, None)
+                    self._job_sessions.pop(job.job_id, None)
+                    self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * (time.time() - started)
+
+    def _run(self, job: IngestionJob, file_path: Path) -> None:
+        self._check_cancelled(job)
+        chunks = self.rag_pipeline.load_cached_chunks(job.fingerprint)
+        if chunks is None:
+            chunks = [Document(page_content=text,
+                               metadata={"source": str(file_path), "filename": file_path.name,
+                                         "fingerprint": job.fingerprint})
+                      for text in self._extract(job, file_path)]
+            self.rag_pipeline.save_cached_chunks(job.fingerprint, chunks)
+        job.chunk_count = len(chunks)
+
+        def on_progress(done: int, total: int) -> None:
+            start = STAGE_PROGRESS["embedding"]
+            self._update(job, "embedding", progress=start + (1.0 - start) * done / total * 0.99)
+
+        try:
+            self._check_cancelled(job)
+        except JobCancelledError:
+            # Nobody is left to see the document, so its stored chunks go too
+            self.rag_pipeline.drop_unlinked_fingerprint(job.fingerprint)
+            raise
+        self._update(job, "embedding")
+        with self._embedding_slot:
+            self.rag_pipeline.index_chunks(chunks, is_permanent=False, progress_callback=on_progress, session_id=None)
+        # Attach every session that uploaded these bytes while the job was running. Later uploads of
+        # the same bytes no longer join this job, they find the document indexed
+        with self._lock:
+            session_ids = set(self._job_sessions.get(job.job_id, ()))
+            for session_id in session_ids:
+                self.rag_pipeline.link_fingerprint(job.fingerprint, session_id)
+            self._inflight.pop(job.fingerprint, None)
+        if not session_ids:
+            # Cancelled while embedding
+            self.rag_pipeline.drop_unlinked_fingerprint(job.fingerprint)
+            raise JobCancelledError()
+        self._update(job, "indexed")
+
+    def _extract(self, job: IngestionJob, file_path: Path) -> List[str]:
+        # Page runs of one document are spread over the worker pool and reassembled in page order
+        stats = TierStats()
+        started = time.time()
+        tasks = plan_tasks(str(file_path), **self.rag_pipeline.extraction_options())
+        stats.seconds["classify"] = time.time() - started
+        futures = [self._pool.submit(convert_pages, job.job_id, str(file_path), *task) for task in tasks]
+        texts = []
+        for done, (task, future) in enumerate(zip(tasks, futures), start=1):
+            task_texts, task_timings = future.result()
+            texts.extend(task_texts)
+            stats.add(task, task_timings)
+            # A finished page run has been chunked too; the progress loop may already be further on
+            start, end = STAGE_PROGRESS["parsing"], STAGE_PROGRESS["embedding"]
+            self._update(job, "chunking", progress=max(job.progress, start + (end - start) * done / len(tasks)))
+        observe_stages(stats.stages)
+        timings = stats.to_dict()
+        job.tier_seconds, job.tier_pages = timings["seconds"], timings["pages"]
+        print(f"Extracted {job.filename}: pages per tier {job.tier_pages}, seconds per tier {job.tier_seconds}")
+        return texts
+
+    def close(self) -> None:
+        for _ in range(self.workers):
+            self._pending.put(None)
+        self._progress.put(None)
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+import heapq
+import math
+import re
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Keeps terms such as "c++", "c#", "node.js" and "gpt-4" intact
+TOKEN_PATTERN = re.compile(r"[a-z0-9](?:[a-z0-9+#]|[._-](?=[a-z0-9]))*")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """In-memory BM25 inverted index over chunks, updated incrementally
+
+    Postings are compact parallel arrays of internal document numbers and term frequencies.
+    Removing a chunk prunes it from the postings of its own terms only.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._doc_numbers: Dict[str, int] = {}  # chunk id -> internal number
+        self._chunk_ids: List[Optional[str]] = []  # internal number -> chunk id (None once removed)
+        self._doc_lengths = array("I")
+        self._doc_terms: Dict[int, Tuple[str, ...]] = {}
+        self._fingerprints: List[str] = []
+        self._permanent = bytearray()
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._doc_numbers)
+
+    def add(self, chunk_ids: Iterable[str], texts: Iterable[str], metadatas: Iterable[dict]) -> None:
+        with self._lock:
+            for chunk_id, text, metadata in zip(chunk_ids, texts, metadatas):
+                if chunk_id in self._doc_numbers:
+                    self._remove_locked([chunk_id])
+                number = len(self._chunk_ids)
+                terms = tokenize(text)
+                frequencies: Dict[str, int] = {}
+                for term in terms:
+                    frequencies[term] = frequencies.get(term, 0) + 1
+                for term, frequency in frequencies.items():
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = (array("I"), array("H"))
+                    postings[0].append(number)
+                    postings[1].append(min(frequency, 65535))
+
+                self._doc_numbers[chunk_id] = number
+                self._chunk_ids.append(chunk_id)
+                self._doc_lengths.append(len(terms))
+                self._doc_terms[number] = tuple(frequencies)
+                self._fingerprints.append(metadata.get("fingerprint", ""))
+                self._permanent.append(1 if metadata.get("is_permanent") else 0)
+                self._total_length += len(terms)
+
+    def remove(self, chunk_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._remove_locked([chunk_id for chunk_id in chunk_ids if chunk_id in self._doc_numbers])
+
+    def _remove_locked(self, chunk_ids: List[str]) -> None:
+        # Each affected posting list is rebuilt once, however many of its chunks go
+        numbers = set()
+        affected_terms = set()
+        for chunk_id in chunk_ids:
+            number = self._doc_numbers.pop(chunk_id)
+            numbers.add(number)
+            affected_terms.update(self._doc_terms.pop(number, ()))
+            self._chunk_ids[number] = None
+            self._total_length -= self._doc_lengths[number]
+        for term in affected_terms:
+            doc_numbers, frequencies = self._postings[term]
+            keep = [i for i, doc in enumerate(doc_numbers) if doc not in numbers]
+            if keep:
+                self._postings[term] = (array("I", (doc_numbers[i] for i in keep)),
+                                        array("H", (frequencies[i] for i in keep)))
+            else:
+                del self._postings[term]
+        if len(self._chunk_ids) > 2 * len(self._doc_numbers) + 1024:
+            self._compact_locked()
+
+    def _compact_locked(self) -> None:
+        # Renumber live chunks so per-chunk arrays do not grow with session churn
+        live = [number for number, chunk_id in enumerate(self._chunk_ids) if chunk_id is not None]
+        renumber = {old: new for new, old in enumerate(live)}
+        for term, (doc_numbers, frequencies) in self._postings.items():
+            self._postings[term] = (array("I", (renumber[number] for number in doc_numbers)), frequencies)
+        self._chunk_ids = [self._chunk_ids[number] for number in live]
+        self._doc_lengths = array("I", (self._doc_lengths[number] for number in live))
+        self._fingerprints = [self._fingerprints[number] for number in live]
+        self._permanent = bytearray(self._permanent[number] for number in live)
+        self._doc_terms = {renumber[number]: terms for number, terms in self._doc_terms.items()}
+        self._doc_numbers = {chunk_id: number for number, chunk_id in enumerate(self._chunk_ids)}
+
+    def search(self, query: str, k: int = 10,
+               visible_fingerprints: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        """Top-k (chunk id, score); only permanent chunks and visible_fingerprints are eligible"""
+        visible_fingerprints = visible_fingerprints or set()
+        with self._lock:
+            live_docs = len(self._doc_numbers)
+            if not live_docs:
+                return []
+            avg_length = self._total_length / live_docs
+            scores: Dict[int, float] = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                numbers, frequencies = postings
+                idf = math.log(1 + (live_docs - len(numbers) + 0.5) / (len(numbers) + 0.5))
+                for number, frequency in zip(numbers, frequencies):
+                    if not self._permanent[number] and self._fingerprints[number] not in visible_fingerprints:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[number] / avg_length)
+                    scores[number] = scores.get(number, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(self._chunk_ids[number], score) for number, score in best]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """Merge ranked id lists; each list contributes 1 / (k + rank) per id"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
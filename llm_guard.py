@@ -0,0 +1,279 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+# Failures that say nothing about the request itself: worth retrying, and counted by the breaker
+RETRYABLE = (asyncio.TimeoutError, OSError, google_exceptions.TooManyRequests,
+             google_exceptions.ServerError, google_exceptions.RetryError)
+
+
+class LLMUnavailableError(Exception):
+    """No answer within the deadline; callers fall back to returning the retrieved context"""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        # circuit_open, deadline_exceeded or exhausted
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and then fails fast
+
+    Once reset_seconds have passed one probe call is let through; its success closes the breaker
+    and its failure keeps it open for another reset_seconds. A probe that never reports back (its
+    caller was cancelled) is replaced after reset_seconds too.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = 0
+        self._opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if self._probe_started is not None else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if self._probe_started is not None and now - self._probe_started < self.reset_seconds:
+                return False
+            if now - self._opened_at < self.reset_seconds:
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probe_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probe_started is not None or (self._opened_at is None
+                                                   and self.failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    self.opened += 1
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+
+    def stats(self) -> dict:
+        return {"state": self.state, "open": int(self._opened_at is not None),
+                "consecutive_failures": self.failures, "opened": self.opened}
+
+
+class LatencyWindow:
+    """Latencies of the most recent successful calls, for the hedging delay"""
+
+    def __init__(self, size: int = 256):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, percent: float, min_samples: int = 20) -> Optional[float]:
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(percent / 100.0 * len(ordered)))]
+
+
+class LLMGuard:
+    """Deadlines, jittered retries, hedging and a circuit breaker around LLM calls
+
+    Every call has an absolute deadline (time.monotonic()), by default request_timeout from now.
+    Each attempt gets at most attempt_timeout of what is left, retryable failures are retried
+    with full-jitter exponential backoff, and with hedging on, an attempt still running after
+    the hedge_percentile of recent latencies gets a duplicate; the first answer wins. Streams are
+    retried only until their first token and are not hedged.
+    """
+
+    def __init__(self, request_timeout: float = 30.0, attempt_timeout: float = 20.0, max_retries: int = 2,
+                 backoff_base: float = 0.2, backoff_max: float = 2.0, hedge: bool = False,
+                 hedge_percentile: float = 95.0, hedge_min_samples: int = 20,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.request_timeout = request_timeout
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyWindow()
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.short_circuited = 0
+        self.deadline_exceeded = 0
+        self.exhausted = 0
+
+    def deadline(self, timeout: Optional[float] = None) -> float:
+        return time.monotonic() + (self.request_timeout if timeout is None else timeout)
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge:
+            return None
+        return self.latencies.percentile(self.hedge_percentile, self.hedge_min_samples)
+
+    def _remaining(self, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.deadline_exceeded += 1
+            raise LLMUnavailableError("Deadline exceeded before Gemini answered", "deadline_exceeded")
+        return remaining
+
+    def _admit(self) -> None:
+        if not self.breaker.allow():
+            self.short_circuited += 1
+            raise LLMUnavailableError("Gemini is failing; circuit breaker is open", "circuit_open")
+
+    def _failed(self, error: BaseException) -> None:
+        """Count a failed attempt, re-raising errors that retrying cannot fix"""
+        if not isinstance(error, RETRYABLE):
+            # Gemini answered, it just rejected this request
+            self.breaker.record_success()
+            raise error
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts += 1
+        self.failures += 1
+        self.breaker.record_failure()
+
+    def _gave_up(self, message: str, deadline: float) -> LLMUnavailableError:
+        # A last attempt cut short by the deadline is reported as such
+        if time.monotonic() >= deadline:
+            self.deadline_exceeded += 1
+            return LLMUnavailableError(message, "deadline_exceeded")
+        self.exhausted += 1
+        return LLMUnavailableError(message, "exhausted")
+
+    async def _backoff(self, attempt: int, deadline: float, error: BaseException) -> None:
+        if attempt == self.max_retries:
+            raise self._gave_up(f"Gemini failed after {attempt + 1} attempts: {error!r}", deadline) from error
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if delay >= self._remaining(deadline):
+            self.deadline_exceeded += 1
+            raise LLMUnavailableError(f"Deadline exceeded retrying Gemini: {error!r}",
+                                      "deadline_exceeded") from error
+        self.retries += 1
+        await asyncio.sleep(delay)
+
+    async def _hedged(self, call: Callable[[], Awaitable[str]], timeout: float) -> str:
+        started = time.monotonic()
+        primary = asyncio.ensure_future(call())
+        tasks: List[asyncio.Future] = [primary]
+        delay = self.hedge_delay()
+        error: Optional[BaseException] = None
+        try:
+            if delay is not None and delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.hedges += 1
+                    tasks.append(asyncio.ensure_future(call()))
+            # The first success wins; the attempt fails only once every copy has
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=started + timeout - time.monotonic(),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        self.latencies.add(time.monotonic() - started)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # A cancelled thread-backed call still runs to completion; its result is dropped
+            for task in tasks:
+                task.cancel()
+
+    async def invoke(self, call: Callable[[], Awaitable[str]], deadline: Optional[float] = None) -> str:
+        deadline = self.deadline() if deadline is None else deadline
+        for attempt in range(self.max_retries + 1):
+            self._admit()
+            timeout = min(self.attempt_timeout, self._remaining(deadline))
+            self.attempts += 1
+            try:
+                answer = await self._hedged(call, timeout)
+            except Exception as e:
+                self._failed(e)
+                await self._backoff(attempt, deadline, e)
+                continue
+            self.breaker.record_success()
+            return answer
+
+    async def stream(self, open_stream: Callable[[], AsyncIterator[str]],
+                     deadline: Optional[float] = None) -> AsyncIterator[str]:
+        deadline = self.deadline() if deadline is None else deadline
+        for attempt in range(self.max_retries + 1):
+            self._admit()
+            timeout = min(self.attempt_timeout, self._remaining(deadline))
+            self.attempts += 1
+            tokens = open_stream()
+            try:
+                first = await asyncio.wait_for(tokens.__anext__(), timeout)
+            except StopAsyncIteration:
+                self.breaker.record_success()
+                return
+            except Exception as e:
+                await tokens.aclose()
+                self._failed(e)
+                await self._backoff(attempt, deadline, e)
+                continue
+            # Once the first token is out, a failure ends the answer instead of retrying it
+            try:
+                yield first
+                while True:
+                    try:
+                        token = await asyncio.wait_for(tokens.__anext__(), self._remaining(deadline))
+                    except StopAsyncIteration:
+                        break
+                    yield token
+            except LLMUnavailableError:
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                self._failed(e)
+                raise self._gave_up(f"Gemini stopped mid-answer: {e!r}", deadline) from e
+            finally:
+                await tokens.aclose()
+            self.breaker.record_success()
+            return
+
+    def stats(self) -> dict:
+        delay = self.hedge_delay()
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "short_circuited": self.short_circuited,
+            "deadline_exceeded": self.deadline_exceeded,
+            "exhausted": self.exhausted,
+            "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None,
+            "breaker": self.breaker.stats(),
+        }
@@ -0,0 +1,195 @@
+"""In-process counters and histograms, rendered in the Prometheus text format for /metrics
+
+No client library or background thread: each metric is a dict of label values guarded by a
+lock, and render() formats the current values when /metrics is scraped. Component stats that
+already exist (caches, batcher, ingestion queue) are read at scrape time via stats collectors.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from a cached retrieval up to a long Docling conversion
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+                                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> [per-bucket counts, sum, count]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def totals(self) -> Dict[Tuple[str, ...], Tuple[float, int]]:
+        """(sum, count) per label values"""
+        with self._lock:
+            return {key: (entry[1], entry[2]) for key, entry in self._values.items()}
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        lines = self.header()
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_stats_collector(self, prefix: str, stats: Callable[[], Optional[dict]],
+                            counters: Sequence[str] = ()) -> None:
+        """Export a component's stats() dict at scrape time, one metric per numeric field
+
+        Nested dicts extend the name (prefix_child_field); fields listed in counters only ever grow
+        and become *_total counters, every other number a gauge.
+        """
+        def collect() -> List[str]:
+            lines: List[str] = []
+            self._flatten(prefix, stats() or {}, set(counters), lines)
+            return lines
+        self._collectors.append(collect)
+
+    def _flatten(self, prefix: str, stats: dict, counters: set, lines: List[str]) -> None:
+        for field, value in stats.items():
+            if isinstance(value, dict):
+                self._flatten(f"{prefix}_{field}", value, counters, lines)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                kind = "counter" if field in counters else "gauge"
+                name = f"{prefix}_{field}" + ("_total" if kind == "counter" else "")
+                lines += [f"# TYPE {name} {kind}", f"{name} {_number(value)}"]
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for collect in self._collectors:
+            try:
+                lines += collect()
+            except Exception as e:
+                # One failing component must not take the whole scrape down
+                lines.append(f"# collector failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_seconds",
+    "Time spent in each pipeline stage (parse and chunk are per document, query stages per query)",
+    ["stage"])
+REQUEST_SECONDS = REGISTRY.histogram("rag_http_request_seconds", "HTTP request latency", ["route", "method", "status"])
+CHUNKS_INDEXED = REGISTRY.counter("rag_chunks_indexed_total", "Chunks written to the vector store", ["kind"])
+PROMPT_TOKENS = REGISTRY.counter(
+    "rag_prompt_tokens_total",
+    "Context tokens retrieved and actually sent to the LLM, counted with the embedding tokenizer",
+    ["kind"])
+CONTEXT_TOKENS = REGISTRY.histogram("rag_context_tokens", "Context tokens per prompt", buckets=TOKEN_BUCKETS)
+CONTEXT_CHUNKS_DROPPED = REGISTRY.counter("rag_context_chunks_dropped_total",
+                                          "Retrieved chunks left out of the prompt", ["reason"])
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram("rag_admission_wait_seconds",
+                                            "Time admitted requests spent queued for a slot", ["pool", "priority"])
+ADMISSION_REJECTED = REGISTRY.counter("rag_admission_rejected_total",
+                                      "Requests turned away by admission control", ["pool", "reason"])
+
+
+def time_stage(stage: str):
+    return STAGE_SECONDS.time(stage=stage)
@@ -0,0 +1,37 @@
+from typing import List
+
+import numpy as np
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def mmr_select(query_vector, candidate_vectors, k: int = 5, lambda_mult: float = 0.5) -> List[int]:
+    """Greedy maximal marginal relevance over a candidate pool; returns candidate indices in pick order
+
+    Cosine similarities between all candidates are computed once, and each pick only folds its
+    row into the running max-similarity-to-selected, so a step is O(fetch_k) vector work.
+    """
+    candidates = np.asarray(candidate_vectors, dtype=np.float32)
+    if candidates.ndim != 2 or len(candidates) == 0 or k <= 0:
+        return []
+    candidates = _normalize(candidates)
+    relevance = candidates @ _normalize(np.asarray(query_vector, dtype=np.float32))
+    similarity = candidates @ candidates.T
+
+    k = min(k, len(candidates))
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()  # max similarity of each candidate to the picks so far
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
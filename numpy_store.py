@@ -0,0 +1,485 @@
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from mmr import mmr_select
+
+# Metadata fields kept as integer-coded columns so filters on them are vectorized
+INDEXED_FIELDS = ("is_permanent", "fingerprint", "filename", "source")
+SCORE_BLOCK_ROWS = 16384
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _value_key(value: Any) -> tuple:
+    # True == 1 in Python, so codes are keyed by type as well as value
+    return (type(value).__name__, value)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class NumpyVectorStore(VectorStore):
+    """Exact in-memory vector index persisted as memory-mapped files
+
+    Embeddings are L2-normalized rows of one contiguous float32/float16 matrix in
+    vectors.npy; ids, texts and metadata are kept in an append-only log replayed at
+    start-up. A query is a matrix multiply over the rows passing the metadata filter.
+    Once the index holds ivf_min_rows live rows, an inverted-file partitioning limits
+    the multiply to the ivf_nprobe partitions closest to the query.
+    """
+
+    def __init__(self, embedding_function: Embeddings, persist_directory: str, dtype: str = "float32",
+                 ivf_min_rows: int = 50_000, ivf_nprobe: int = 8):
+        self._embedding = embedding_function
+        self.persist_directory = Path(persist_directory)
+        self.persist_directory.mkdir(parents=True, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        self.ivf_min_rows = ivf_min_rows
+        self.ivf_nprobe = ivf_nprobe
+
+        self._lock = threading.RLock()
+        self._vectors_path = self.persist_directory / "vectors.npy"
+        self._log_path = self.persist_directory / "records.jsonl"
+        self._compact_vectors_path = self.persist_directory / "vectors.compact.npy"
+        self._compact_log_path = self.persist_directory / "records.compact.jsonl"
+        self._finish_compaction()
+        self._reset()
+        self._load()
+        self._log = open(self._log_path, "a", encoding="utf-8")
+
+    def _reset(self) -> None:
+        self._vectors: Optional[np.memmap] = None
+        self._size = 0
+        self._ids: List[Optional[str]] = []
+        self._documents: List[Optional[str]] = []
+        self._metadatas: List[Optional[dict]] = []
+        self._rows: Dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+        self._columns = {field: np.zeros(0, dtype=np.int32) for field in INDEXED_FIELDS}
+        self._codes: Dict[str, Dict[tuple, int]] = {field: {} for field in INDEXED_FIELDS}
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._ivf_trained_rows = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    # Persistence
+
+    def _load(self) -> None:
+        if not self._vectors_path.exists():
+            return
+        self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+        self.dtype = self._vectors.dtype
+        self._grow(self._vectors.shape[0])
+        if not self._log_path.exists():
+            return
+        with open(self._log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["op"] == "add":
+                    self._append_row(record["row"], record["id"], record["text"], record["metadata"])
+                else:
+                    self._delete_rows(record["rows"], copy_on_write=False)
+
+    def _create_vectors(self, capacity: int, dim: int, path: Path) -> np.memmap:
+        return np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(capacity, dim))
+
+    def _grow(self, capacity: int) -> None:
+        extra = capacity - len(self._alive)
+        if extra <= 0:
+            return
+        self._alive = np.concatenate([self._alive, np.zeros(extra, dtype=bool)])
+        self._assignments = np.concatenate([self._assignments, np.full(extra, -1, dtype=np.int32)])
+        for field in INDEXED_FIELDS:
+            self._columns[field] = np.concatenate([self._columns[field], np.full(extra, -1, dtype=np.int32)])
+
+    def _ensure_capacity(self, rows_needed: int, dim: int) -> None:
+        if self._vectors is None:
+            self._vectors = self._create_vectors(max(1024, rows_needed), dim, self._vectors_path)
+        elif rows_needed > self._vectors.shape[0]:
+            capacity = max(rows_needed, 2 * self._vectors.shape[0])
+            tmp_path = self._vectors_path.with_suffix(".tmp.npy")
+            grown = self._create_vectors(capacity, self._vectors.shape[1], tmp_path)
+            grown[:self._size] = self._vectors[:self._size]
+            grown.flush()
+            del grown
+            self._vectors = None
+            os.replace(tmp_path, self._vectors_path)
+            self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+        self._grow(self._vectors.shape[0])
+
+    def _write_log(self, records: List[dict]) -> None:
+        self._log.write("".join(json.dumps(record) + "\n" for record in records))
+        self._log.flush()
+
+    def compact(self) -> None:
+        """Rewrite the files without deleted rows
+
+        The new files are written next to the old ones and swapped in with os.replace, so a
+        crash at any point leaves either the old store or the compacted one.
+        """
+        with self._lock:
+            live = np.flatnonzero(self._alive[:self._size])
+            if self._vectors is not None:
+                vectors = self._create_vectors(max(1024, len(live)), self._vectors.shape[1],
+                                               self._compact_vectors_path)
+                for start in range(0, len(live), SCORE_BLOCK_ROWS):
+                    block = live[start:start + SCORE_BLOCK_ROWS]
+                    vectors[start:start + len(block)] = self._vectors[block]
+                vectors.flush()
+                del vectors
+            pending_log = self._compact_log_path.with_suffix(".tmp")
+            with open(pending_log, "w", encoding="utf-8") as f:
+                for new_row, row in enumerate(live):
+                    f.write(json.dumps({"op": "add", "row": new_row, "id": self._ids[row],
+                                        "text": self._documents[row], "metadata": self._metadatas[row]}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            # The compacted log appearing under its final name commits the compaction
+            os.replace(pending_log, self._compact_log_path)
+
+            self._log.close()
+            self._vectors = None
+            self._finish_compaction()
+            self._reset()
+            self._load()
+            self._log = open(self._log_path, "a", encoding="utf-8")
+
+    def _finish_compaction(self) -> None:
+        """Swap in a committed compaction, or discard one interrupted before its commit"""
+        if not self._compact_log_path.exists():
+            for path in (self._compact_vectors_path, self._compact_log_path.with_suffix(".tmp")):
+                if path.exists():
+                    os.remove(path)
+            return
+        if self._compact_vectors_path.exists():
+            os.replace(self._compact_vectors_path, self._vectors_path)
+        os.replace(self._compact_log_path, self._log_path)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+            self._log.close()
+
+    # Row bookkeeping
+
+    def _append_row(self, row: int, chunk_id: str, text: str, metadata: dict) -> None:
+        while len(self._ids) <= row:
+            self._ids.append(None)
+            self._documents.append(None)
+            self._metadatas.append(None)
+        self._ids[row] = chunk_id
+        self._documents[row] = text
+        self._metadatas[row] = metadata
+        self._rows[chunk_id] = row
+        self._alive[row] = True
+        for field in INDEXED_FIELDS:
+            if field in metadata:
+                codes = self._codes[field]
+                key = _value_key(metadata[field])
+                if key not in codes:
+                    codes[key] = len(codes)
+                self._columns[field][row] = codes[key]
+        self._size = max(self._size, row + 1)
+
+    def _delete_rows(self, rows: Iterable[int], copy_on_write: bool = True) -> None:
+        if copy_on_write:
+            # Searches in flight hold the current lists (see _snapshot), so clear rows in fresh copies
+            self._ids = list(self._ids)
+            self._documents = list(self._documents)
+            self._metadatas = list(self._metadatas)
+        for row in rows:
+            chunk_id = self._ids[row]
+            if chunk_id is not None and self._rows.get(chunk_id) == row:
+                del self._rows[chunk_id]
+            self._ids[row] = None
+            self._documents[row] = None
+            self._metadatas[row] = None
+            self._alive[row] = False
+
+    @staticmethod
+    def _document(row: int, snapshot: tuple) -> Document:
+        _, ids, documents, metadatas = snapshot
+        return Document(page_content=documents[row], metadata=dict(metadatas[row] or {}), id=ids[row])
+
+    def _snapshot(self) -> tuple:
+        # Deletes and compaction replace these objects rather than mutating them, so searches keep
+        # reading the rows they started with
+        return (self._vectors, self._ids, self._documents, self._metadatas)
+
+    # Filters
+
+    def _mask(self, where: Optional[dict]) -> np.ndarray:
+        alive = self._alive[:self._size]
+        if not where:
+            return alive.copy()
+        return alive & self._evaluate(where)
+
+    def _evaluate(self, where: dict) -> np.ndarray:
+        if "$and" in where:
+            return np.logical_and.reduce([self._evaluate(clause) for clause in where["$and"]])
+        if "$or" in where:
+            return np.logical_or.reduce([self._evaluate(clause) for clause in where["$or"]])
+        masks = []
+        for field, condition in where.items():
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for operator, value in condition.items():
+                masks.append(self._field_mask(field, operator, value))
+        return np.logical_and.reduce(masks)
+
+    def _field_mask(self, field: str, operator: str, value: Any) -> np.ndarray:
+        if field in self._columns:
+            codes = self._columns[field][:self._size]
+            lookup = self._codes[field]
+            if operator in ("$eq", "$ne"):
+                mask = codes == lookup.get(_value_key(value), -2)
+                return mask if operator == "$eq" else ~mask
+            if operator in ("$in", "$nin"):
+                mask = np.isin(codes, [lookup.get(_value_key(v), -2) for v in value])
+                return mask if operator == "$in" else ~mask
+        matchers = {
+            "$eq": lambda x: x == value,
+            "$ne": lambda x: x != value,
+            "$in": lambda x: x in value,
+            "$nin": lambda x: x not in value,
+        }
+        if operator not in matchers:
+            raise ValueError(f"Unsupported filter operator {operator}")
+        match = matchers[operator]
+        return np.fromiter((metadata is not None and match(metadata.get(field)) for metadata in self._metadatas),
+                           dtype=bool, count=self._size)
+
+    # Writes
+
+    def add_embeddings(self, texts: Sequence[str], embeddings: Sequence[Sequence[float]],
+                       metadatas: Optional[Sequence[dict]] = None, ids: Optional[Sequence[str]] = None) -> List[str]:
+        """Add precomputed embeddings; existing ids are replaced"""
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [uuid.uuid4().hex for _ in texts]
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+
+        with self._lock:
+            self._delete_by_ids([chunk_id for chunk_id in ids if chunk_id in self._rows])
+            start = self._size
+            self._ensure_capacity(start + len(texts), vectors.shape[1])
+            self._vectors[start:start + len(texts)] = vectors.astype(self.dtype)
+            self._vectors.flush()
+            records = []
+            for offset, (chunk_id, text, metadata) in enumerate(zip(ids, texts, metadatas)):
+                self._append_row(start + offset, chunk_id, text, metadata)
+                records.append({"op": "add", "row": start + offset, "id": chunk_id, "text": text,
+                                "metadata": metadata})
+            if self._centroids is not None:
+                self._assignments[start:start + len(texts)] = np.argmax(vectors @ self._centroids.T, axis=1)
+            self._write_log(records)
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(texts, self._embedding.embed_documents(texts), metadatas, ids=ids)
+
+    def _delete_by_ids(self, ids: List[str]) -> None:
+        rows = [self._rows[chunk_id] for chunk_id in ids if chunk_id in self._rows]
+        if rows:
+            self._delete_rows(rows)
+            self._write_log([{"op": "delete", "rows": rows}])
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, **kwargs: Any) -> None:
+        with self._lock:
+            if ids:
+                self._delete_by_ids(list(ids))
+            if where:
+                rows = np.flatnonzero(self._mask(where)).tolist()
+                if rows:
+                    self._delete_rows(rows)
+                    self._write_log([{"op": "delete", "rows": rows}])
+            deleted = self._size - len(self._rows)
+            if deleted > max(1024, len(self._rows)):
+                self.compact()
+
+    # Reads
+
+    def get(self, ids: Optional[Sequence[str]] = None, where: Optional[dict] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None,
+            include: Optional[List[str]] = None, **kwargs: Any) -> Dict[str, list]:
+        include = ["documents", "metadatas"] if include is None else include
+        with self._lock:
+            if ids is not None:
+                rows = [self._rows[chunk_id] for chunk_id in ids if chunk_id in self._rows]
+                if where:
+                    mask = self._mask(where)
+                    rows = [row for row in rows if mask[row]]
+            else:
+                rows = np.flatnonzero(self._mask(where)).tolist()
+            rows = rows[offset or 0:]
+            if limit is not None:
+                rows = rows[:limit]
+            result = {"ids": [self._ids[row] for row in rows]}
+            if "documents" in include:
+                result["documents"] = [self._documents[row] for row in rows]
+            if "metadatas" in include:
+                result["metadatas"] = [dict(self._metadatas[row]) for row in rows]
+            if "embeddings" in include:
+                result["embeddings"] = np.array(self._vectors[rows], dtype=np.float32)
+        return result
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        with self._lock:
+            snapshot = self._snapshot()
+            return [self._document(self._rows[chunk_id], snapshot) for chunk_id in ids if chunk_id in self._rows]
+
+    def _scores(self, vectors: np.ndarray, rows: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        # Blocked so float16 storage is upcast a slice at a time rather than all at once
+        scores = np.empty((len(rows), len(queries)), dtype=np.float32)
+        for start in range(0, len(rows), SCORE_BLOCK_ROWS):
+            block_rows = rows[start:start + SCORE_BLOCK_ROWS]
+            if len(block_rows) and block_rows[-1] - block_rows[0] == len(block_rows) - 1:
+                block = vectors[block_rows[0]:block_rows[-1] + 1]
+            else:
+                block = vectors[block_rows]
+            scores[start:start + len(block_rows)] = block.astype(np.float32, copy=False) @ queries.T
+        return scores
+
+    def _train_ivf(self, vectors: np.ndarray, live_rows: np.ndarray) -> None:
+        rng = np.random.default_rng(0)
+        n_lists = max(1, int(np.sqrt(len(live_rows))))
+        sample_rows = np.sort(rng.choice(live_rows, size=min(len(live_rows), n_lists * 64), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(10):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=n_lists)
+            nonempty = counts > 0
+            centroids[nonempty] = _normalize(sums[nonempty])
+
+        assignments = np.full(len(self._assignments), -1, dtype=np.int32)
+        for start in range(0, self._size, SCORE_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        self._centroids = centroids
+        self._assignments = assignments
+        self._ivf_trained_rows = len(live_rows)
+
+    def _search(self, queries: np.ndarray, k: int, where: Optional[dict]) -> List[Tuple[np.ndarray, np.ndarray, tuple]]:
+        queries = _normalize(np.asarray(queries, dtype=np.float32))
+        with self._lock:
+            snapshot = self._snapshot()
+            vectors = self._vectors
+            if vectors is None:
+                return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32), snapshot)] * len(queries)
+            mask = self._mask(where)
+            rows = np.flatnonzero(mask)
+            use_ivf = self.ivf_min_rows > 0 and len(self._rows) >= self.ivf_min_rows
+            if use_ivf and (self._centroids is None or len(self._rows) > 2 * self._ivf_trained_rows):
+                self._train_ivf(vectors, np.flatnonzero(self._alive[:self._size]))
+            centroids = self._centroids if use_ivf else None
+            assignments = self._assignments[:self._size] if use_ivf else None
+
+        results = []
+        if centroids is None:
+            scores = self._scores(vectors, rows, queries)
+            for column in range(len(queries)):
+                order = _top_k(scores[:, column], k)
+                results.append((rows[order], scores[order, column], snapshot))
+            return results
+
+        for query in queries:
+            probes = np.argsort(-(centroids @ query))[:self.ivf_nprobe]
+            candidates = rows[np.isin(assignments[rows], probes)]
+            if len(candidates) < k:
+                candidates = rows  # Filter too selective for the probed partitions: fall back to exact
+            scores = self._scores(vectors, candidates, query[None, :])[:, 0]
+            order = _top_k(scores, k)
+            results.append((candidates[order], scores[order], snapshot))
+        return results
+
+    def query_by_vectors(self, query_embeddings: Sequence[Sequence[float]], n_results: int = 10,
+                         where: Optional[dict] = None, include: Optional[List[str]] = None) -> Dict[str, list]:
+        """Multi-query search returning a Chroma-style result dict"""
+        include = include or ["documents", "metadatas", "distances"]
+        result: Dict[str, list] = {"ids": [], "documents": [], "metadatas": [], "embeddings": [], "distances": []}
+        queries = np.asarray(query_embeddings)
+        for rows, scores, (vectors, ids, documents, metadatas) in self._search(queries, n_results, where):
+            result["ids"].append([ids[row] for row in rows])
+            result["documents"].append([documents[row] for row in rows])
+            result["metadatas"].append([dict(metadatas[row]) for row in rows])
+            result["distances"].append((1.0 - scores).tolist())
+            if "embeddings" in include:
+                # An empty store has no vector file yet
+                result["embeddings"].append(np.asarray(vectors[rows], dtype=np.float32) if vectors is not None
+                                            else np.zeros((0, queries.shape[-1]), dtype=np.float32))
+        return result
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        rows, scores, snapshot = self._search(np.asarray([embedding]), k, filter)[0]
+        return [(self._document(row, snapshot), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                          **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4,
+                                                 **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score(query, k, kwargs.get("filter"))
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, filter: Optional[dict] = None,
+                                                **kwargs: Any) -> List[Document]:
+        rows, _, snapshot = self._search(np.asarray([embedding]), fetch_k, filter)[0]
+        if len(rows) == 0:
+            return []
+        candidates = np.asarray(snapshot[0][rows], dtype=np.float32)
+        selected = mmr_select(embedding, candidates, k=k, lambda_mult=lambda_mult)
+        return [self._document(rows[i], snapshot) for i in selected]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                      filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(self._embedding.embed_query(query), k, fetch_k,
+                                                            lambda_mult, filter)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, persist_directory: str = "./numpy_index",
+                   **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding_function=embedding, persist_directory=persist_directory, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
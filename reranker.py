@@ -0,0 +1,74 @@
+import hashlib
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from query_cache import TTLCache
+
+
+class CrossEncoderReranker:
+    """Reorders retrieved chunks by a CPU cross-encoder's (query, chunk) relevance score
+
+    Scores are cached by (query hash, chunk id); chunk ids are derived from content hashes, so a
+    cached score stays valid for as long as the chunk exists. Pairs are scored in batches, and
+    once the time budget is spent the candidates are returned in their original (dense) order.
+    """
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size: int = 16,
+                 budget_ms: float = 300.0, cache_size: int = 20000, cache_ttl: float = 3600.0):
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.model = CrossEncoder(model_name, device="cpu")
+        self.score_cache = TTLCache(max_entries=cache_size, ttl_seconds=cache_ttl)
+        self.reranked = 0
+        self.over_budget = 0
+        self.pairs_scored = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        return hashlib.sha256(" ".join(query.lower().split()).encode("utf-8")).hexdigest()
+
+    def rerank(self, query: str, docs: List[Document], top_n: int,
+               budget_ms: Optional[float] = None) -> Tuple[List[Document], bool]:
+        """The top_n docs by cross-encoder score, and whether scoring finished within the budget"""
+        if not docs:
+            return docs, True
+        deadline = time.perf_counter() + (self.budget_ms if budget_ms is None else budget_ms) / 1000.0
+        query_hash = self.query_hash(query)
+        scores = [self.score_cache.get((query_hash, doc.id)) for doc in docs]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        for start in range(0, len(missing), self.batch_size):
+            if time.perf_counter() >= deadline:
+                with self._stats_lock:
+                    self.over_budget += 1
+                return docs[:top_n], False
+            batch = missing[start:start + self.batch_size]
+            batch_scores = self.model.predict([(query, docs[i].page_content) for i in batch],
+                                              batch_size=self.batch_size, show_progress_bar=False)
+            for i, score in zip(batch, batch_scores):
+                scores[i] = float(score)
+                # Scores of a batch that overran the budget are still worth keeping for next time
+                self.score_cache.put((query_hash, docs[i].id), scores[i])
+
+        with self._stats_lock:
+            self.reranked += 1
+            self.pairs_scored += len(missing)
+        # Stable sort, so ties keep their dense order
+        order = sorted(range(len(docs)), key=lambda i: -scores[i])
+        return [docs[i] for i in order[:top_n]], True
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "reranked": self.reranked,
+            "over_budget": self.over_budget,
+            "pairs_scored": self.pairs_scored,
+            "score_cache": self.score_cache.stats(),
+        }
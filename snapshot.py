@@ -0,0 +1,185 @@
+"""Prebuilt snapshots of the permanent corpus
+
+A snapshot holds the parsed chunks, their embeddings and metadata, plus a manifest with the
+embedding model, extraction and chunker settings and package versions it was built with. textRAG mounts it
+at start-up instead of running Docling and the embedding model over the permanent documents.
+
+    python snapshot.py build --output ./index_snapshot          # resume only
+    python snapshot.py build --output ./index_snapshot --all    # every PDF/TXT in the folder
+    python snapshot.py info --snapshot ./index_snapshot
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from importlib import metadata
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+SNAPSHOT_FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+CHUNKS_FILE = "chunks.jsonl"
+EMBEDDINGS_FILE = "embeddings.npy"
+# Embedded at build and load time; a different vector means different model weights
+PROBE_TEXT = "Senior software engineer with experience in Python, machine learning and cloud deployment."
+PROBE_MIN_SIMILARITY = 0.999
+
+
+def _package_version(name: str) -> str:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def compatibility(rag_pipeline) -> dict:
+    """Everything that changes the chunks or vectors a build would produce"""
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "embedding_model": rag_pipeline.embedding_model_name,
+        "chunker": {"max_chunk_size": rag_pipeline.max_chunk_size, "merge_peers": True},
+        # Which pages skip Docling, and where page runs (chunked separately) start and end
+        "extraction": rag_pipeline.extraction_options(),
+        "packages": {name: _package_version(name)
+                     for name in ("docling", "langchain-docling", "sentence-transformers", "transformers")},
+    }
+
+
+def version_hash(settings: dict) -> str:
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _probe(rag_pipeline) -> np.ndarray:
+    # Bypasses the embedding cache, which is keyed by model name only
+    vector = np.asarray(rag_pipeline.embedding_batcher.embed_documents([PROBE_TEXT])[0], dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def _document_key(rag_pipeline, source: str) -> str:
+    # Relative to the documents folder, so same-named files in different subfolders stay apart
+    path = Path(source).resolve()
+    try:
+        return path.relative_to(rag_pipeline.folder_path.resolve()).as_posix()
+    except ValueError:
+        return path.as_posix()
+
+
+def build_snapshot(rag_pipeline, output_dir: str, documents: List[Path]) -> dict:
+    chunks = rag_pipeline.parse_documents(documents, is_permanent=True)
+    for chunk in chunks:
+        chunk.metadata["is_permanent"] = True
+    vectors = np.asarray(rag_pipeline.embedding_model.embed_documents([chunk.page_content for chunk in chunks]),
+                         dtype=np.float32)
+    settings = compatibility(rag_pipeline)
+    manifest = {
+        **settings,
+        "version_hash": version_hash(settings),
+        "probe_vector": _probe(rag_pipeline).tolist(),
+        "dimension": int(vectors.shape[1]) if len(vectors) else 0,
+        "chunk_count": len(chunks),
+        "documents": {_document_key(rag_pipeline, chunk.metadata["source"]): chunk.metadata["fingerprint"]
+                      for chunk in chunks},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+    # Written next to the target and swapped in, so a failed build never leaves half a snapshot
+    output = Path(output_dir)
+    staging = output.with_name(output.name + ".tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    with open(staging / CHUNKS_FILE, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps({"text": chunk.page_content, "metadata": chunk.metadata}) + "\n")
+    np.save(staging / EMBEDDINGS_FILE, vectors)
+    with open(staging / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(staging, output)
+    return manifest
+
+
+def read_manifest(snapshot_dir: str) -> Optional[dict]:
+    path = Path(snapshot_dir) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_compatible(rag_pipeline, manifest: dict) -> Optional[str]:
+    """None if the snapshot can be mounted, otherwise the reason it cannot"""
+    current = compatibility(rag_pipeline)
+    if manifest.get("version_hash") != version_hash(current):
+        changed = [key for key in current if manifest.get(key) != current[key]]
+        return f"built with different {', '.join(changed) or 'settings'}"
+    for document, fingerprint in manifest["documents"].items():
+        local_path = rag_pipeline.folder_path / document
+        if local_path.exists() and rag_pipeline.fingerprint_file(local_path) != fingerprint:
+            return f"{document} changed since the snapshot was built"
+    similarity = float(np.dot(_probe(rag_pipeline), np.asarray(manifest["probe_vector"], dtype=np.float32)))
+    if similarity < PROBE_MIN_SIMILARITY:
+        return f"embedding model weights differ (probe similarity {similarity:.4f})"
+    return None
+
+
+def load_snapshot(rag_pipeline, snapshot_dir: str) -> Optional[List[Document]]:
+    """Index a compatible snapshot as permanent documents; None if there is none or it is stale"""
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        return None
+    reason = check_compatible(rag_pipeline, manifest)
+    if reason is not None:
+        print(f"Ignoring snapshot {snapshot_dir}: {reason}")
+        return None
+
+    chunks = []
+    with open(Path(snapshot_dir) / CHUNKS_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            chunks.append(Document(page_content=record["text"], metadata=record["metadata"]))
+    vectors = np.load(Path(snapshot_dir) / EMBEDDINGS_FILE)
+    rag_pipeline.index_chunks(chunks, is_permanent=True, embeddings=vectors)
+    print(f"Mounted snapshot {snapshot_dir} with {len(chunks)} chunks from {len(manifest['documents'])} documents")
+    return chunks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build or inspect permanent-corpus snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Parse and embed the permanent documents into a snapshot")
+    build.add_argument("--output", default=os.getenv("RAG_SNAPSHOT_DIR", "./index_snapshot"))
+    build.add_argument("--folder", default="pdfs")
+    build.add_argument("--resume-file", default="ManishKumarResume.pdf")
+    build.add_argument("--all", action="store_true", help="Include every PDF/TXT in the folder, not just the resume")
+    info = commands.add_parser("info", help="Print a snapshot's manifest and whether it can be mounted")
+    info.add_argument("--snapshot", default=os.getenv("RAG_SNAPSHOT_DIR", "./index_snapshot"))
+    info.add_argument("--folder", default="pdfs")
+    args = parser.parse_args()
+
+    from textRAG import textRAG
+
+    if args.command == "build":
+        rag_pipeline = textRAG(folder_path=args.folder, resume_file=args.resume_file, warm_up=False)
+        documents = rag_pipeline.find_documents() if args.all else [Path(args.folder) / args.resume_file]
+        manifest = build_snapshot(rag_pipeline, args.output, documents)
+        print(f"Snapshot written to {args.output}: {manifest['chunk_count']} chunks "
+              f"from {len(manifest['documents'])} documents")
+    else:
+        manifest = read_manifest(args.snapshot)
+        if manifest is None:
+            print(f"No snapshot in {args.snapshot}")
+            return
+        rag_pipeline = textRAG(folder_path=args.folder, warm_up=False)
+        summary = {key: value for key, value in manifest.items() if key != "probe_vector"}
+        print(json.dumps(summary, indent=2))
+        print(f"Compatible: {check_compatible(rag_pipeline, manifest) or 'yes'}")
+    rag_pipeline.close()
+
+
+if __name__ == "__main__":
+    main()
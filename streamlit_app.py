@@ -4,7 +4,9 @@ import tempfile
 import shutil
 from pathlib import Path
 import time
+import uuid
 from textRAG import textRAG
+from ingestion import UploadSpool
 
 # Set page configuration
 st.set_page_config(
@@ -23,6 +25,8 @@ if 'rag_pipeline' not in st.session_state:
     st.session_state.rag_pipeline = None
 if 'rag_initialized' not in st.session_state:
     st.session_state.rag_initialized = False
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 @st.cache_resource
 def initialize_rag():
@@ -37,40 +41,52 @@ def cleanup_session_documents():
     """Clean up session documents"""
     if st.session_state.rag_pipeline:
         try:
-            st.session_state.rag_pipeline.cleanup_session_documents()
+            st.session_state.rag_pipeline.cleanup_session_documents(st.session_state.session_id)
             return True
         except Exception as e:
             st.error(f"Error cleaning up session: {str(e)}")
             return False
     return False
 
-def add_temporary_document(file_content, filename):
+def add_temporary_document(uploaded_file):
     """Add a temporary document to the RAG system"""
     if st.session_state.rag_pipeline:
         try:
-            temp_path = st.session_state.rag_pipeline.add_temporary_document(file_content, filename)
-            return temp_path is not None
+            # Written to disk in blocks and hashed on the way, rather than copied into one bytes object
+            uploaded_file.seek(0)
+            spool, fingerprint = UploadSpool.from_file(uploaded_file, uploaded_file.name)
+            try:
+                result = st.session_state.rag_pipeline.add_temporary_file(spool.path, st.session_state.session_id,
+                                                                          fingerprint=fingerprint)
+            finally:
+                spool.discard()
+            return result is not None
         except Exception as e:
             st.error(f"Error adding document: {str(e)}")
             return False
     return False
 
-def query_documents(question):
-    """Query the RAG system"""
+def stream_documents(question, result):
+    """Yield answer tokens as Gemini produces them and store the sources in result"""
     if st.session_state.rag_pipeline:
         try:
-            context = st.session_state.rag_pipeline.query_documents(question)
-            answer = st.session_state.rag_pipeline.generate_response(question, context)
-            return {"answer": answer, "source_documents": context}
+            rag = st.session_state.rag_pipeline
+            session_id = st.session_state.session_id
+            result["retrieval_query"], history = rag.contextualize_query(question, session_id)
+            context = rag.query_documents(result["retrieval_query"], session_id=session_id)
+            result["source_documents"] = context
+            tokens = []
+            for token in rag.stream_response(question, context, history=history):
+                tokens.append(token)
+                yield token
+            rag.remember_turn(session_id, question, "".join(tokens))
         except Exception as e:
             st.error(f"Error querying documents: {str(e)}")
-            return None
-    return None
 
 # App title and description
 st.title("📚 RAG Document Assistant")
 st.markdown("Ask questions about documents! ManishKumar's resume is always available, and you can upload additional PDFs for your session.")
-st.markdown("*Disclaimer: This is a demo application with limited functionality. There is no chat history implemented due to memory constraints, hence each question is independent of previous ones. Please note that uploading a 4-page PDF may take 1–2 minutes to process.*")
+st.markdown("*Disclaimer: This is a demo application with limited functionality. Your recent questions are remembered so follow-ups like 'what about his Java?' work; older ones are condensed to a line each to bound memory, and the history is forgotten after 30 minutes idle. Please note that uploading a 4-page PDF may take 1–2 minutes to process.*")
 
 # Initialize RAG system
 if not st.session_state.rag_initialized:
@@ -114,8 +130,7 @@ if uploaded_file is not None:
     if uploaded_file.name not in st.session_state.uploaded_files:
         with st.spinner(f"Uploading and processing {uploaded_file.name}..."):
             try:
-                file_bytes = uploaded_file.read()
-                success = add_temporary_document(file_bytes, uploaded_file.name)
+                success = add_temporary_document(uploaded_file)
                 
                 if success:
                     st.session_state.uploaded_files.append(uploaded_file.name)
@@ -152,16 +167,17 @@ with col2:
 
 if submit_button:
     if question and st.session_state.rag_initialized:
-        with st.spinner("Thinking..."):
-            result = query_documents(question)
-            if result:
-                st.subheader("Answer")
-                st.write(result["answer"])
-                
-                with st.expander("Source Context"):
-                    st.text(result["source_documents"])
-            else:
-                st.error("Failed to get an answer. Please try again.")
+        result = {}
+        st.subheader("Answer")
+        st.write_stream(stream_documents(question, result))
+        if result.get("retrieval_query") not in (None, question):
+            st.caption(f"Searched as a follow-up: {result['retrieval_query']}")
+
+        if result.get("source_documents") is not None:
+            with st.expander("Source Context"):
+                st.text(result["source_documents"])
+        else:
+            st.error("Failed to get an answer. Please try again.")
     else:
         if not st.session_state.rag_initialized:
             st.error("RAG system is not ready. Please wait for initialization.")
@@ -1,54 +1,135 @@
 import os
-import tempfile
-import shutil
+import json
+import asyncio
+import hashlib
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 from langchain_core.documents import Document
-from langchain_docling import DoclingLoader
-from langchain_docling.loader import ExportType
-from docling.chunking import HybridChunker
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.output_parsers import StrOutputParser
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from transformers import AutoTokenizer, AutoModel
 from dotenv import load_dotenv
-# from ragatouille import RAGPretrainedModel
-from langchain.retrievers import ContextualCompressionRetriever
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from embedding_service import MicroBatchingEmbeddings
+from query_cache import TTLCache
+from singleflight import SingleFlight
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from numpy_store import NumpyVectorStore
+from mmr import mmr_select
+from context_packer import PackedContext, pack_context
+from reranker import CrossEncoderReranker
+from llm_guard import CircuitBreaker, LLMGuard, LLMUnavailableError
+from conversation import ConversationStore, rewrite_query
+from metrics import CHUNKS_INDEXED, CONTEXT_CHUNKS_DROPPED, CONTEXT_TOKENS, PROMPT_TOKENS, STAGE_SECONDS, time_stage
+from snapshot import load_snapshot
+from directory_sync import sync_directory
+from tiered_extraction import DOCLING_TIER, convert_task, plan_tasks
+
+
+DEFAULT_SESSION = "default"
 
 
 class textRAG:
-    def __init__(self, folder_path: str = "pdfs", resume_file: str = "ManishKumarResume.pdf"):
+    def __init__(self, folder_path: str = "pdfs", resume_file: str = "ManishKumarResume.pdf", warm_up: bool = True):
+        started = time.perf_counter()
         load_dotenv()
-        os.environ["LANGCHAIN_TRACING_V2"] = "true"
-        os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-        os.environ["LANGSMITH_API_KEY"] = os.getenv("LANGSMITH_API_KEY")
+        # LangSmith tracing adds a network call to every chain run, so it is opt-in:
+        # set LANGCHAIN_TRACING_V2=true (and LANGSMITH_API_KEY) in the environment or .env
+        os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
         self.folder_path = Path(folder_path)
         self.resume_file = resume_file
-        self.persist_directory = "./test_chroma_db"
-        self.temp_files = []  # Track temporary files for cleanup
-        self.session_documents = []  # Track documents added in current session
-        
-        self.tokenizer = AutoTokenizer.from_pretrained("avsolatorio/GIST-large-Embedding-v0", trust_remote_code=True)
-        self.embedding_model = HuggingFaceEmbeddings(model_name="avsolatorio/GIST-large-Embedding-v0")
-        self.max_chunk_size = self.tokenizer.model_max_length 
-        self.chunker = HybridChunker(
-            tokenizer=self.tokenizer,
-            max_chunk_size=self.max_chunk_size,
-            merge_peers=True,)
-        
-        self.vector_store = Chroma(collection_name="collection",
-                                    embedding_function=self.embedding_model,
-                                    persist_directory=self.persist_directory,)
+        self.persist_directory = os.getenv("RAG_CHROMA_DIR", "./test_chroma_db")
+        # Uploads are shared by content hash: each session sees the hashes it uploaded,
+        # and a hash's chunks are deleted once no session references it any more
+        self.session_fingerprints: Dict[str, set] = {}  # session id -> content hashes
+        self.fingerprint_sessions: Dict[str, set] = {}  # content hash -> session ids
+        self.fingerprint_chunk_ids: Dict[str, List[str]] = {}  # content hash -> chunk ids in the vector store
+        self._index_lock = threading.Lock()
+        # Bumped on every index change; part of every cache key so stale entries are never served
+        self.index_version = 0
+        cache_ttl = float(os.getenv("RAG_CACHE_TTL_SECONDS", "3600"))
+        self.retrieval_cache = TTLCache(max_entries=int(os.getenv("RAG_RETRIEVAL_CACHE_SIZE", "1024")),
+                                        ttl_seconds=cache_ttl)
+        self.answer_cache = TTLCache(max_entries=int(os.getenv("RAG_ANSWER_CACHE_SIZE", "512")),
+                                     ttl_seconds=cache_ttl)
+        # Exact-term matches (skills, acronyms, project names) from BM25 are fused with dense results
+        self.hybrid_retrieval = os.getenv("RAG_HYBRID_RETRIEVAL", "true").lower() == "true"
+        self.rrf_k = int(os.getenv("RAG_RRF_K", "60"))
+        # Dense results are diversified with MMR over a pool of fetch_k nearest chunks
+        self.mmr_k = int(os.getenv("RAG_MMR_K", "5"))
+        self.mmr_fetch_k = int(os.getenv("RAG_MMR_FETCH_K", "50"))
+        self.mmr_lambda = float(os.getenv("RAG_MMR_LAMBDA", "0.5"))
+        # Optional CPU cross-encoder pass over a wider candidate pool, cut short by a time budget
+        self.rerank_enabled = os.getenv("RAG_RERANK", "false").lower() == "true"
+        self.rerank_model_name = os.getenv("RAG_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+        self.rerank_candidates = int(os.getenv("RAG_RERANK_CANDIDATES", "20"))
+        self.rerank_budget_ms = float(os.getenv("RAG_RERANK_BUDGET_MS", "300"))
+        self.rerank_batch_size = int(os.getenv("RAG_RERANK_BATCH_SIZE", "16"))
+        self.rerank_cache_size = int(os.getenv("RAG_RERANK_CACHE_SIZE", "20000"))
+        # Context sent to the LLM, counted with the embedding model's tokenizer
+        self.context_max_tokens = int(os.getenv("RAG_CONTEXT_MAX_TOKENS", "2000"))
+        self.context_dedup_threshold = float(os.getenv("RAG_CONTEXT_DEDUP_THRESHOLD", "0.8"))
+        self.context_min_truncate_tokens = int(os.getenv("RAG_CONTEXT_MIN_TRUNCATE_TOKENS", "64"))
+        self.lexical_index = BM25Index()
+        # Concurrent identical retrievals and generations share one computation
+        self.retrieval_flights = SingleFlight()
+        self.generation_flights = SingleFlight()
+        # Parsed chunks keyed by content hash, so repeated uploads skip Docling
+        self.chunk_store_dir = Path(os.getenv("RAG_CHUNK_STORE_DIR", "./chunk_store"))
+        self.chunk_store_dir.mkdir(parents=True, exist_ok=True)
+        # Least recently used files are removed beyond this; a session's are removed with it
+        self.chunk_store_max_bytes = int(float(os.getenv("RAG_CHUNK_STORE_MAX_MB", "512")) * 1024 * 1024)
+        # PDF pages with a usable text layer skip Docling's layout and OCR models
+        self.fast_extraction = os.getenv("RAG_FAST_EXTRACTION", "true").lower() == "true"
+        self.fast_min_chars = int(os.getenv("RAG_FAST_MIN_CHARS", "200"))
+        self.pages_per_task = int(os.getenv("RAG_PAGES_PER_TASK", "4"))
+
+        # A bounded executor keeps CPU-bound embedding and search off the event loop; uploads are
+        # parsed by the API's IngestionQueue instead
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RAG_RETRIEVAL_WORKERS", "16")),
+                                                     thread_name_prefix="rag-retrieval")
+        self.llm_concurrency = int(os.getenv("RAG_LLM_CONCURRENCY", "16"))
+        self._llm_semaphore = None
+        self.batch_llm_concurrency = int(os.getenv("RAG_BATCH_LLM_CONCURRENCY", "8"))
+        # Another Gemini-compatible endpoint, e.g. the local stand-in in benchmarks/fake_gemini.py
+        self.gemini_endpoint = os.getenv("RAG_GEMINI_ENDPOINT") or None
+        self.gemini_transport = os.getenv("RAG_GEMINI_TRANSPORT") or ("rest" if self.gemini_endpoint else None)
+        # Deadlines, retries, hedging and the circuit breaker for the async (API) Gemini calls
+        self.llm_guard = LLMGuard(
+            request_timeout=float(os.getenv("RAG_REQUEST_TIMEOUT_SECONDS", "30")),
+            attempt_timeout=float(os.getenv("RAG_LLM_ATTEMPT_TIMEOUT_SECONDS", "20")),
+            max_retries=int(os.getenv("RAG_LLM_MAX_RETRIES", "2")),
+            backoff_base=float(os.getenv("RAG_LLM_BACKOFF_BASE_MS", "200")) / 1000.0,
+            backoff_max=float(os.getenv("RAG_LLM_BACKOFF_MAX_MS", "2000")) / 1000.0,
+            hedge=os.getenv("RAG_LLM_HEDGE", "false").lower() == "true",
+            hedge_percentile=float(os.getenv("RAG_LLM_HEDGE_PERCENTILE", "95")),
+            breaker=CircuitBreaker(failure_threshold=int(os.getenv("RAG_LLM_BREAKER_FAILURES", "5")),
+                                   reset_seconds=float(os.getenv("RAG_LLM_BREAKER_RESET_SECONDS", "30"))),
+        )
         
-        self.llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0)
+        self.embedding_model_name = "avsolatorio/GIST-large-Embedding-v0"
+        # Chunk and query vectors are cached on disk by hash of model name and text
+        self.embedding_cache = EmbeddingCache(path=os.getenv("RAG_EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite"),
+                                              model_name=self.embedding_model_name,
+                                              max_entries=int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", "200000")))
+        self.vector_backend = os.getenv("RAG_VECTOR_BACKEND", "chroma").lower()
+        # Prebuilt permanent corpus (see snapshot.py), mounted when the vector store lacks the resume
+        self.snapshot_dir = os.getenv("RAG_SNAPSHOT_DIR", "./index_snapshot")
 
         self.prompt = ChatPromptTemplate.from_template("""
                                 You are an AI assistant that provides accurate and helpful information based on the given context.
 
+                                Conversation so far (use it only to understand what the question refers to):
+                                {history}
+
                                 Context:
                                 {context}
 
@@ -57,13 +138,212 @@ class textRAG:
 
                                 Provide a comprehensive and engaging answer based on the context. If the specific information required to answer the question is not present, acknowledge that clearly. However, try to identify the most relevant or similar experience, skill, or project mentioned in the context, and explain how it can be considered transferable or applicable in this case.
                                 """)
-        
-        # Ensure resume is always loaded
-        self._ensure_resume_loaded()
-        
-        # # Initialize ColBERT model for reranking
-        # self.colbert_model = RAGPretrainedModel.from_pretrained("colbert-ir/colbertv2.0")
 
+        # Recent questions and answers per session, under a token and byte cap each; 0 sessions disables history
+        self.conversations = ConversationStore(
+            count_tokens=self.count_tokens,
+            max_sessions=int(os.getenv("RAG_HISTORY_MAX_SESSIONS", "5000")),
+            ttl_seconds=float(os.getenv("RAG_HISTORY_TTL_SECONDS", "1800")),
+            max_tokens=int(os.getenv("RAG_HISTORY_MAX_TOKENS", "1024")),
+            max_bytes=int(os.getenv("RAG_HISTORY_MAX_BYTES", "16384")),
+        )
+
+        # The embedding model, chunker, vector store and Gemini client are built on first use
+        # (or by warm_up), so constructing the pipeline is cheap and the API can bind its port first
+        self._init_lock = threading.RLock()
+        self._tokenizer = None
+        self._embedding_batcher: Optional[MicroBatchingEmbeddings] = None
+        self._embedding_model: Optional[CachedEmbeddings] = None
+        self._chunker = None
+        self._converter = None
+        self._vector_store = None
+        self._reranker: Optional[CrossEncoderReranker] = None
+        self.llm = None
+        self._rag_chain = None
+        self._sync_rag_chain = None
+        self.ready = threading.Event()
+        self.warm_up_error: Optional[str] = None
+        self.startup_timings: Dict[str, float] = {"config": time.perf_counter() - started}
+
+        if warm_up:
+            self.warm_up()
+
+    @contextmanager
+    def _startup_stage(self, name: str):
+        started = time.perf_counter()
+        yield
+        self.startup_timings[name] = time.perf_counter() - started
+
+    def _load_embedding_model(self) -> None:
+        with self._init_lock:
+            if self._embedding_model is not None:
+                return
+            with self._startup_stage("embedding_model"):
+                embeddings = HuggingFaceEmbeddings(model_name=self.embedding_model_name)
+                # Reuse the SentenceTransformer's tokenizer rather than loading it a second time
+                self._tokenizer = embeddings._client.tokenizer
+                # Cache misses from concurrent queries are embedded together in one forward pass
+                self._embedding_batcher = MicroBatchingEmbeddings(
+                    embeddings,
+                    max_batch_size=int(os.getenv("RAG_EMBED_MAX_BATCH", "32")),
+                    max_wait_ms=float(os.getenv("RAG_EMBED_BATCH_WINDOW_MS", "5")))
+                self._embedding_model = CachedEmbeddings(self._embedding_batcher, self.embedding_cache)
+
+    @property
+    def tokenizer(self):
+        self._load_embedding_model()
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    @property
+    def max_chunk_size(self) -> int:
+        return self.tokenizer.model_max_length
+
+    @property
+    def embedding_batcher(self) -> MicroBatchingEmbeddings:
+        self._load_embedding_model()
+        return self._embedding_batcher
+
+    @property
+    def embedding_model(self) -> CachedEmbeddings:
+        self._load_embedding_model()
+        return self._embedding_model
+
+    @property
+    def chunker(self):
+        with self._init_lock:
+            if self._chunker is None:
+                with self._startup_stage("chunker"):
+                    # Docling is imported here so only ingestion pays for it
+                    from docling.chunking import HybridChunker
+                    self._chunker = HybridChunker(tokenizer=self.tokenizer,
+                                                  max_chunk_size=self.max_chunk_size,
+                                                  merge_peers=True,)
+        return self._chunker
+
+    @property
+    def converter(self):
+        with self._init_lock:
+            if self._converter is None:
+                from docling.document_converter import DocumentConverter
+                self._converter = DocumentConverter()
+        return self._converter
+
+    def extraction_options(self) -> dict:
+        return {"fast_path": self.fast_extraction, "min_chars": self.fast_min_chars,
+                "pages_per_task": self.pages_per_task}
+
+    @property
+    def vector_store(self):
+        with self._init_lock:
+            if self._vector_store is None:
+                embedding_model = self.embedding_model
+                with self._startup_stage("vector_store"):
+                    self._vector_store = self._create_vector_store(embedding_model)
+                with self._startup_stage("lexical_index"):
+                    self._load_lexical_index()
+        return self._vector_store
+
+    @property
+    def reranker(self) -> CrossEncoderReranker:
+        with self._init_lock:
+            if self._reranker is None:
+                with self._startup_stage("reranker"):
+                    self._reranker = CrossEncoderReranker(model_name=self.rerank_model_name,
+                                                          batch_size=self.rerank_batch_size,
+                                                          budget_ms=self.rerank_budget_ms,
+                                                          cache_size=self.rerank_cache_size,
+                                                          cache_ttl=self.retrieval_cache.ttl_seconds)
+        return self._reranker
+
+    @property
+    def rag_chain(self):
+        with self._init_lock:
+            if self._rag_chain is None:
+                with self._startup_stage("llm"):
+                    client_options = {"api_endpoint": self.gemini_endpoint} if self.gemini_endpoint else None
+                    # llm_guard owns the retry policy, so langchain's tenacity retry is turned off
+                    # (releases before 2.1.12 ignore max_retries and always make one extra attempt)
+                    self.llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0,
+                                                      client_options=client_options,
+                                                      transport=self.gemini_transport, max_retries=0)
+                    # The Google client's own retry backs off for up to 10 minutes on 5xx; llm_guard
+                    # retries instead, and every call is cut off at the attempt timeout
+                    llm = self.llm.bind(retry=None, timeout=self.llm_guard.attempt_timeout)
+                    self._rag_chain = self.prompt | llm | StrOutputParser()
+        return self._rag_chain
+
+    @property
+    def sync_rag_chain(self):
+        """Chain for generate_response/stream_response (Streamlit, CLI), which do not go through
+        llm_guard, so it keeps the client's and langchain's default retries"""
+        with self._init_lock:
+            if self._sync_rag_chain is None:
+                client_options = {"api_endpoint": self.gemini_endpoint} if self.gemini_endpoint else None
+                llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0, client_options=client_options,
+                                             transport=self.gemini_transport)
+                self._sync_rag_chain = self.prompt | llm | StrOutputParser()
+        return self._sync_rag_chain
+
+    def warm_up(self) -> None:
+        """Build every lazy component, load the resume and run one embedding, logging the time of each stage"""
+        started = time.perf_counter()
+        try:
+            self.vector_store
+            self.rag_chain
+            with self._startup_stage("resume"):
+                # Ensure resume is always loaded
+                self._ensure_resume_loaded()
+            with self._startup_stage("embedding_warmup"):
+                # The first forward pass initializes torch kernels; pay for it before real traffic
+                self.embedding_batcher.embed_documents(["warm up"])
+                if self.rerank_enabled:
+                    self.reranker.model.predict([("warm up", "warm up")], show_progress_bar=False)
+        except Exception as e:
+            self.warm_up_error = str(e)
+            print(f"Warm-up failed: {e}")
+            raise
+        self.startup_timings["warm_up_total"] = time.perf_counter() - started
+        self.ready.set()
+        print("Startup timings: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.startup_timings.items()))
+
+    def readiness(self) -> dict:
+        status = "ready" if self.ready.is_set() else "failed" if self.warm_up_error else "warming_up"
+        return {"status": status, "error": self.warm_up_error,
+                "startup_timings": {name: round(seconds, 3) for name, seconds in self.startup_timings.items()}}
+
+    def _create_vector_store(self, embedding_model: CachedEmbeddings):
+        if self.vector_backend == "numpy":
+            return NumpyVectorStore(embedding_function=embedding_model,
+                                    persist_directory=os.getenv("RAG_NUMPY_INDEX_DIR", "./numpy_index"),
+                                    dtype=os.getenv("RAG_NUMPY_DTYPE", "float32"),
+                                    ivf_min_rows=int(os.getenv("RAG_IVF_MIN_ROWS", "50000")),
+                                    ivf_nprobe=int(os.getenv("RAG_IVF_NPROBE", "8")))
+        if self.vector_backend != "chroma":
+            raise ValueError(f"Unknown RAG_VECTOR_BACKEND {self.vector_backend}, expected chroma or numpy")
+        return Chroma(collection_name="collection",
+                      embedding_function=embedding_model,
+                      persist_directory=self.persist_directory,)
+
+    def _query_by_vectors(self, vectors: List[List[float]], n_results: int, where: dict) -> dict:
+        if isinstance(self.vector_store, NumpyVectorStore):
+            return self.vector_store.query_by_vectors(vectors, n_results=n_results, where=where,
+                                                      include=["documents", "metadatas", "embeddings"])
+        return self.vector_store._collection.query(
+            query_embeddings=vectors,
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas", "embeddings"],
+        )
+
+    def _load_lexical_index(self) -> None:
+        if not self.hybrid_retrieval:
+            return
+        permanent_docs = self._vector_store.get(where={"is_permanent": True}, include=["documents", "metadatas"])
+        self.lexical_index.add(permanent_docs["ids"], permanent_docs["documents"], permanent_docs["metadatas"])
+        print(f"Lexical index loaded with {len(self.lexical_index)} chunks")
 
     def _ensure_resume_loaded(self) -> None:
         resume_path = self.folder_path / self.resume_file
@@ -73,13 +353,10 @@ class textRAG:
         
         # Check if resume is already in vector store
         try:
-            existing_docs = self.vector_store.get()
-            resume_exists = any(
-                metadata.get('filename') == self.resume_file 
-                for metadata in existing_docs.get('metadatas', [])
-            )
+            existing_docs = self.vector_store.get(where={"filename": self.resume_file}, limit=1, include=[])
+            resume_exists = bool(existing_docs.get('ids'))
             
-            if not resume_exists:
+            if not resume_exists and load_snapshot(self, self.snapshot_dir) is None:
                 print(f"Loading resume: {self.resume_file}")
                 self.index_documents([resume_path], is_permanent=True)
             else:
@@ -95,78 +372,235 @@ class textRAG:
                     documents.append(Path(os.path.join(root, file)))
         return documents
     
-    def add_temporary_document(self, file_content: bytes, filename: str) -> str:
-        # Create temporary file
-        temp_dir = tempfile.mkdtemp()
-        temp_file_path = Path(temp_dir) / filename
-        
-        # Write content to temporary file
-        with open(temp_file_path, 'wb') as f:
-            f.write(file_content)
-        
-        # Track temporary files for cleanup
-        self.temp_files.append(temp_dir)
-        
-        # Index the temporary document
-        indexed_docs = self.index_documents([temp_file_path], is_permanent=False)
-        
-        return str(temp_file_path)
+    @staticmethod
+    def fingerprint_file(file_path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _chunk_store_path(self, fingerprint: str) -> Path:
+        # Keyed by the extraction settings too, since they change which tier parses each page
+        options = hashlib.sha256(json.dumps(self.extraction_options(), sort_keys=True).encode("utf-8")).hexdigest()
+        return self.chunk_store_dir / f"{fingerprint}.{options[:12]}.json"
+
+    def load_cached_chunks(self, fingerprint: str) -> Optional[List[Document]]:
+        chunk_path = self._chunk_store_path(fingerprint)
+        try:
+            with open(chunk_path, 'r', encoding='utf-8') as f:
+                chunks = [Document(page_content=chunk["page_content"], metadata=chunk["metadata"])
+                          for chunk in json.load(f)]
+        except FileNotFoundError:
+            return None
+        # The modification time doubles as last-used time for the size bound
+        os.utime(chunk_path)
+        return chunks
+
+    def save_cached_chunks(self, fingerprint: str, chunks: List[Document]) -> None:
+        chunk_path = self._chunk_store_path(fingerprint)
+        tmp_path = chunk_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in chunks], f)
+        os.replace(tmp_path, chunk_path)
+        self._trim_chunk_store(keep=chunk_path)
+
+    def _trim_chunk_store(self, keep: Path) -> None:
+        entries = []
+        for entry in os.scandir(self.chunk_store_dir):
+            if entry.name.endswith(".json") and entry.path != str(keep):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries) + keep.stat().st_size
+        for _, size, path in sorted(entries):
+            if total <= self.chunk_store_max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            total -= size
+
+    def delete_cached_chunks(self, fingerprint: str) -> None:
+        # Under every extraction-settings key, not just the current one
+        for chunk_path in self.chunk_store_dir.glob(f"{fingerprint}.*.json"):
+            chunk_path.unlink(missing_ok=True)
+
+    def _attach_session(self, fingerprint: str, session_id: str) -> None:
+        # Caller holds self._index_lock
+        self.session_fingerprints.setdefault(session_id, set()).add(fingerprint)
+        self.fingerprint_sessions.setdefault(fingerprint, set()).add(session_id)
+
+    def link_fingerprint(self, fingerprint: str, session_id: str = DEFAULT_SESSION) -> bool:
+        with self._index_lock:
+            if fingerprint not in self.fingerprint_chunk_ids:
+                return False
+            self._attach_session(fingerprint, session_id)
+            return True
+
+    def visible_fingerprints(self, session_id: str = DEFAULT_SESSION) -> List[str]:
+        with self._index_lock:
+            return sorted(self.session_fingerprints.get(session_id, ()))
+
+    def _session_filter(self, session_id: str = DEFAULT_SESSION) -> dict:
+        fingerprints = self.visible_fingerprints(session_id)
+        if not fingerprints:
+            return {"is_permanent": True}
+        return {"$or": [{"is_permanent": True}, {"fingerprint": {"$in": fingerprints}}]}
+
+    def add_temporary_file(self, file_path: Path, session_id: str = DEFAULT_SESSION,
+                           fingerprint: Optional[str] = None) -> dict:
+        """Index a file already on disk for one session; the caller keeps ownership of file_path"""
+        file_path = Path(file_path)
+        filename = file_path.name
+        fingerprint = fingerprint or self.fingerprint_file(file_path)
+
+        # Same bytes already indexed: just make them visible to this session
+        if self.link_fingerprint(fingerprint, session_id):
+            print(f"{filename} already indexed ({fingerprint[:12]}), skipping processing")
+            return {"fingerprint": fingerprint, "deduplicated": True}
+
+        chunks = self.load_cached_chunks(fingerprint)
+        if chunks is None:
+            chunks = self._load_chunks([file_path], is_permanent=False)
+            for doc in chunks:
+                doc.metadata["fingerprint"] = fingerprint
+            self.save_cached_chunks(fingerprint, chunks)
+        else:
+            print(f"Reusing parsed chunks for {filename} ({fingerprint[:12]})")
+
+        self.index_chunks(chunks, is_permanent=False, session_id=session_id)
+        return {"fingerprint": fingerprint, "deduplicated": False}
     
-    def cleanup_session_documents(self) -> None:
+    def cleanup_session_documents(self, session_id: str = DEFAULT_SESSION) -> None:
+        self.conversations.drop(session_id)
         try:
-            if self.session_documents:
-                all_docs = self.vector_store.get()
-                
+            # Only this session's chunks are touched, so cost is independent of corpus size
+            with self._index_lock:
                 ids_to_remove = []
-                for i, metadata in enumerate(all_docs.get('metadatas', [])):
-                    source = metadata.get('source', '')
-                    if any(temp_doc in source for temp_doc in self.session_documents):
-                        ids_to_remove.append(all_docs['ids'][i])
-                
-                if ids_to_remove:
-                    self.vector_store.delete(ids=ids_to_remove)
-                    print(f"Removed {len(ids_to_remove)} session documents from vector store")
-            
-            # Clean up temporary files
-            for temp_dir in self.temp_files:
-                if os.path.exists(temp_dir):
-                    shutil.rmtree(temp_dir)
-                    print(f"Cleaned up temporary directory: {temp_dir}")
-            
-            # Reset tracking lists
-            self.temp_files = []
-            self.session_documents = []
+                for fingerprint in self.session_fingerprints.pop(session_id, set()):
+                    sessions = self.fingerprint_sessions.get(fingerprint, set())
+                    sessions.discard(session_id)
+                    if not sessions:
+                        self.fingerprint_sessions.pop(fingerprint, None)
+                        ids_to_remove.extend(self.fingerprint_chunk_ids.pop(fingerprint, []))
+                        self.delete_cached_chunks(fingerprint)
+
+            if ids_to_remove:
+                self.delete_chunks(ids_to_remove)
+                print(f"Removed {len(ids_to_remove)} session documents from vector store")
             
         except Exception as e:
             print(f"Error during cleanup: {e}")
 
-    def index_documents(self, documents: list, is_permanent: bool = True) -> list:
-        docloader = DoclingLoader(file_path=documents,
-                        export_type=ExportType.DOC_CHUNKS,
-                        chunker=self.chunker)
-        documents_loaded = docloader.load()
+    def drop_unlinked_fingerprint(self, fingerprint: str) -> None:
+        """Delete a document's chunks if no session links to it (its uploaders left while it was indexed)"""
+        with self._index_lock:
+            if self.fingerprint_sessions.get(fingerprint):
+                return
+            ids_to_remove = self.fingerprint_chunk_ids.pop(fingerprint, [])
+        self.delete_cached_chunks(fingerprint)
+        if ids_to_remove:
+            self.delete_chunks(ids_to_remove)
+
+    def delete_chunks(self, chunk_ids: List[str]) -> None:
+        self.vector_store.delete(ids=chunk_ids)
+        self.lexical_index.remove(chunk_ids)
+        self._bump_index_version()
+
+    @staticmethod
+    def chunk_id(fingerprint: str, position: int, is_permanent: bool = True) -> str:
+        # Deterministic ids make re-indexing the same content an upsert instead of a duplicate
+        return f"{'permanent' if is_permanent else 'session'}:{fingerprint}:{position}"
 
+    def _load_chunks(self, documents: list, is_permanent: bool = True) -> List[Document]:
         processed_docs = []
-        for doc in documents_loaded:
-            orig_metadata = doc.metadata
-            filename = Path(orig_metadata.get("source", "")).name
-            source = str(orig_metadata.get("source", ""))
-            processed_doc = Document(
-                page_content=doc.page_content,
-                metadata={
-                    "source": source,
-                    "filename": filename,
-                    "is_permanent": is_permanent,
-                    # "page": page_num
-                    }
-            )
-            processed_docs.append(processed_doc)
-
-        self.vector_store.add_documents(processed_docs)
-        
+        for document in documents:
+            source = str(document)
+            tier_seconds: Dict[str, float] = {}
+            stage_seconds: Dict[str, float] = {}
+            for tier, first_page, last_page in plan_tasks(source, **self.extraction_options()):
+                started = time.perf_counter()
+                texts = convert_task(source, tier, first_page, last_page, self.chunker,
+                                     converter=self.converter if tier == DOCLING_TIER else None,
+                                     timings=stage_seconds)
+                tier_seconds[tier] = tier_seconds.get(tier, 0.0) + time.perf_counter() - started
+                for text in texts:
+                    processed_docs.append(Document(
+                        page_content=text,
+                        metadata={
+                            "source": source,
+                            "filename": Path(source).name,
+                            "is_permanent": is_permanent,
+                            # "page": page_num
+                            }
+                    ))
+            for stage, seconds in stage_seconds.items():
+                STAGE_SECONDS.observe(seconds, stage=stage)
+            print(f"Extracted {Path(source).name}: " + ", ".join(f"{tier} {seconds:.2f}s"
+                                                                 for tier, seconds in tier_seconds.items()))
+        return processed_docs
+
+    def index_chunks(self, chunks: List[Document], is_permanent: bool = True,
+                     progress_callback: Optional[Callable[[int, int], None]] = None,
+                     batch_size: int = 64, session_id: Optional[str] = DEFAULT_SESSION,
+                     embeddings: Optional[np.ndarray] = None) -> List[str]:
+        counters: Dict[str, int] = {}
+        ids = []
+        for doc in chunks:
+            doc.metadata["is_permanent"] = is_permanent
+            fingerprint = doc.metadata.get("fingerprint", "")
+            position = counters.get(fingerprint, 0)
+            counters[fingerprint] = position + 1
+            ids.append(self.chunk_id(fingerprint, position, is_permanent))
+
+        for start in range(0, len(chunks), batch_size):
+            batch = chunks[start:start + batch_size]
+            if embeddings is None:
+                # Embedded here rather than inside the store so the two stages are timed separately
+                with time_stage("embed"):
+                    vectors = self.embedding_model.embed_documents([doc.page_content for doc in batch])
+            else:
+                vectors = embeddings[start:start + batch_size]
+            with time_stage("vector_upsert"):
+                self._add_embedded(batch, vectors, ids[start:start + batch_size])
+            if self.hybrid_retrieval:
+                self.lexical_index.add(ids[start:start + batch_size],
+                                       [doc.page_content for doc in chunks[start:start + batch_size]],
+                                       [doc.metadata for doc in chunks[start:start + batch_size]])
+            if progress_callback:
+                progress_callback(min(start + batch_size, len(chunks)), len(chunks))
+        self._bump_index_version()
+        CHUNKS_INDEXED.inc(len(chunks), kind="permanent" if is_permanent else "session")
+
         if not is_permanent:
-            self.session_documents.extend([str(doc_path) for doc_path in documents])
-        
+            with self._index_lock:
+                for doc, chunk_id in zip(chunks, ids):
+                    self.fingerprint_chunk_ids.setdefault(doc.metadata["fingerprint"], []).append(chunk_id)
+                if session_id is not None:
+                    for fingerprint in counters:
+                        self._attach_session(fingerprint, session_id)
+        return ids
+
+    def _add_embedded(self, chunks: List[Document], vectors: np.ndarray, ids: List[str]) -> None:
+        texts = [doc.page_content for doc in chunks]
+        metadatas = [doc.metadata for doc in chunks]
+        if isinstance(self.vector_store, NumpyVectorStore):
+            self.vector_store.add_embeddings(texts, vectors, metadatas, ids=ids)
+        else:
+            self.vector_store._collection.upsert(ids=ids, embeddings=np.asarray(vectors, dtype=np.float32),
+                                                 documents=texts, metadatas=metadatas)
+
+    def parse_documents(self, documents: list, is_permanent: bool = True) -> List[Document]:
+        processed_docs = self._load_chunks(documents, is_permanent=is_permanent)
+        fingerprints = {str(doc_path): self.fingerprint_file(doc_path) for doc_path in documents}
+        for doc in processed_docs:
+            doc.metadata["fingerprint"] = fingerprints.get(doc.metadata["source"], "")
+        return processed_docs
+
+    def index_documents(self, documents: list, is_permanent: bool = True) -> list:
+        processed_docs = self.parse_documents(documents, is_permanent=is_permanent)
+        self.index_chunks(processed_docs, is_permanent=is_permanent)
         return processed_docs
 
     
@@ -175,37 +609,418 @@ class textRAG:
         return loaded_docs
     
     
-    def query_documents(self, query: str, use_reranker: bool = True) -> str:
-        retriever = self.vector_store.as_retriever(
-                        search_type="mmr", 
-                        search_kwargs={"k": 5, "fetch_k": 10}
-                    )
-        
-        # if use_reranker:
-        #     compressor = self.colbert_model.as_langchain_document_compressor()
-            
-        #     compression_retriever = ContextualCompressionRetriever(
-        #         base_compressor=compressor,
-        #         base_retriever=retriever
-        #     )
-            
-        #     reranked_docs = compression_retriever.invoke(query)
-        #     context_str = "\n\n\n".join([doc.page_content for doc in reranked_docs])
+    def _bump_index_version(self) -> None:
+        with self._index_lock:
+            self.index_version += 1
 
-        # else:
-        retrieved_docs = retriever.invoke(query)
-        context_str = "\n\n\n".join([doc.page_content for doc in retrieved_docs])
-            
-        return context_str
-    
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split()).rstrip("?!. ")
+
+    @staticmethod
+    def _context_hash(context: str) -> str:
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+    def _answer_cache_key(self, query: str, context: str, history: str = "") -> tuple:
+        # History is only passed for follow-ups, which can mean something else after another conversation
+        return (self.index_version, self._context_hash(context), self.normalize_query(query),
+                self._context_hash(history) if history else "")
+
+    def _mmr_params(self, k: Optional[int] = None, fetch_k: Optional[int] = None,
+                    lambda_mult: Optional[float] = None) -> tuple:
+        k = k or self.mmr_k
+        fetch_k = max(fetch_k or self.mmr_fetch_k, k)
+        lambda_mult = self.mmr_lambda if lambda_mult is None else lambda_mult
+        return k, fetch_k, lambda_mult
+
+    def _retrieval_cache_key(self, query: str, session_id: str = DEFAULT_SESSION,
+                             mmr_params: Optional[tuple] = None, use_reranker: bool = False) -> tuple:
+        return (self.index_version, self.normalize_query(query), tuple(self.visible_fingerprints(session_id)),
+                mmr_params or self._mmr_params(), use_reranker)
+
+    def _cached_retrieval(self, cache_key: tuple) -> Optional[List[Document]]:
+        cached_ids = self.retrieval_cache.get(cache_key)
+        if cached_ids is not None:
+            docs_by_id = {doc.id: doc for doc in self.vector_store.get_by_ids(cached_ids)}
+            if len(docs_by_id) == len(cached_ids):
+                return [docs_by_id[chunk_id] for chunk_id in cached_ids]
+        return None
+
+    def _dense_search(self, vectors: List[List[float]], session_id: str, k: int, fetch_k: int,
+                      lambda_mult: float) -> List[List[Document]]:
+        # Candidate vectors come back with the search, so MMR needs no second lookup
+        with time_stage("vector_search"):
+            found = self._query_by_vectors(vectors, n_results=fetch_k, where=self._session_filter(session_id))
+        results = []
+        for row, vector in enumerate(vectors):
+            with time_stage("mmr"):
+                selected = mmr_select(vector, found["embeddings"][row], k=k, lambda_mult=lambda_mult)
+            results.append([Document(page_content=found["documents"][row][j],
+                                     metadata=found["metadatas"][row][j] or {},
+                                     id=found["ids"][row][j])
+                            for j in selected])
+        return results
+
+    def _candidate_pool(self, k: int, fetch_k: int, use_reranker: bool) -> tuple:
+        # The cross-encoder picks k from a wider pool than MMR and fusion alone would return
+        pool_k = max(k, self.rerank_candidates) if use_reranker else k
+        return pool_k, max(fetch_k, pool_k)
+
+    def _finish_retrieval(self, query: str, dense_docs: List[Document], session_id: str, k: int, fetch_k: int,
+                          use_reranker: bool, cache_key: tuple) -> List[Document]:
+        pool_k, fetch_k = self._candidate_pool(k, fetch_k, use_reranker)
+        with time_stage("lexical_fusion"):
+            retrieved_docs = self._fuse_lexical(query, dense_docs, session_id, k=pool_k, fetch_k=fetch_k)
+        complete = True
+        if use_reranker:
+            with time_stage("rerank"):
+                retrieved_docs, complete = self.reranker.rerank(query, retrieved_docs, top_n=k)
+        # A result cut short by the rerank budget is not cached, so a later request can finish it
+        if complete:
+            self.retrieval_cache.put(cache_key, [doc.id for doc in retrieved_docs])
+        return retrieved_docs
+
+    def retrieve(self, query: str, session_id: str = DEFAULT_SESSION, k: Optional[int] = None,
+                 fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                 use_reranker: Optional[bool] = None) -> List[Document]:
+        with time_stage("retrieve"):
+            k, fetch_k, lambda_mult = self._mmr_params(k, fetch_k, lambda_mult)
+            use_reranker = self.rerank_enabled if use_reranker is None else use_reranker
+            cache_key = self._retrieval_cache_key(query, session_id, (k, fetch_k, lambda_mult), use_reranker)
+            cached_docs = self._cached_retrieval(cache_key)
+            if cached_docs is not None:
+                return cached_docs
+
+            # Pre-filter to the permanent documents plus this session's uploads
+            pool_k, pool_fetch_k = self._candidate_pool(k, fetch_k, use_reranker)
+            with time_stage("embed_query"):
+                vector = self.embedding_model.embed_query(query)
+            dense_docs = self._dense_search([vector], session_id, pool_k, pool_fetch_k, lambda_mult)[0]
+            return self._finish_retrieval(query, dense_docs, session_id, k, fetch_k, use_reranker, cache_key)
+
+    def _fuse_lexical(self, query: str, dense_docs: List[Document], session_id: str = DEFAULT_SESSION,
+                      k: int = 5, fetch_k: int = 10) -> List[Document]:
+        if not self.hybrid_retrieval:
+            return dense_docs
+        lexical_hits = self.lexical_index.search(query, k=fetch_k,
+                                                 visible_fingerprints=set(self.visible_fingerprints(session_id)))
+        if not lexical_hits:
+            return dense_docs
+
+        fused_ids = reciprocal_rank_fusion([[doc.id for doc in dense_docs], [chunk_id for chunk_id, _ in lexical_hits]],
+                                           k=self.rrf_k)[:k]
+        docs_by_id = {doc.id: doc for doc in dense_docs}
+        missing = [chunk_id for chunk_id in fused_ids if chunk_id not in docs_by_id]
+        if missing:
+            docs_by_id.update({doc.id: doc for doc in self.vector_store.get_by_ids(missing)})
+        return [docs_by_id[chunk_id] for chunk_id in fused_ids if chunk_id in docs_by_id]
+
+    def retrieve_batch(self, queries: List[str], session_id: str = DEFAULT_SESSION, k: Optional[int] = None,
+                       fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                       use_reranker: Optional[bool] = None) -> List[List[Document]]:
+        k, fetch_k, lambda_mult = self._mmr_params(k, fetch_k, lambda_mult)
+        use_reranker = self.rerank_enabled if use_reranker is None else use_reranker
+        results: List[Optional[List[Document]]] = [None] * len(queries)
+        cache_keys = [self._retrieval_cache_key(query, session_id, (k, fetch_k, lambda_mult), use_reranker)
+                      for query in queries]
+        pending = []
+        for i, cache_key in enumerate(cache_keys):
+            results[i] = self._cached_retrieval(cache_key)
+            if results[i] is None:
+                pending.append(i)
+        if not pending:
+            return results
+
+        # One forward pass for every uncached question, then one multi-query vector search
+        with time_stage("embed_query"):
+            vectors = self.embedding_model.embed_queries([queries[i] for i in pending])
+        pool_k, pool_fetch_k = self._candidate_pool(k, fetch_k, use_reranker)
+        dense_results = self._dense_search(vectors, session_id, pool_k, pool_fetch_k, lambda_mult)
+        for i, dense_docs in zip(pending, dense_results):
+            results[i] = self._finish_retrieval(queries[i], dense_docs, session_id, k, fetch_k, use_reranker,
+                                                cache_keys[i])
+        return results
+
+    def pack_context(self, docs: List[Document]) -> PackedContext:
+        with time_stage("prompt_build"):
+            packed = pack_context(docs, self.tokenizer, max_tokens=self.context_max_tokens,
+                                  dedup_threshold=self.context_dedup_threshold,
+                                  min_truncate_tokens=self.context_min_truncate_tokens)
+        PROMPT_TOKENS.inc(packed.retrieved_tokens, kind="retrieved")
+        PROMPT_TOKENS.inc(packed.context_tokens, kind="context")
+        CONTEXT_TOKENS.observe(packed.context_tokens)
+        CONTEXT_CHUNKS_DROPPED.inc(packed.duplicates_dropped, reason="duplicate")
+        CONTEXT_CHUNKS_DROPPED.inc(packed.retrieved_chunks - packed.duplicates_dropped - packed.context_chunks,
+                                   reason="budget")
+        return packed
+
+    def query_context(self, query: str, session_id: str = DEFAULT_SESSION, k: Optional[int] = None,
+                      fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                      use_reranker: Optional[bool] = None) -> PackedContext:
+        retrieved_docs = self.retrieve(query, session_id=session_id, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult,
+                                       use_reranker=use_reranker)
+        return self.pack_context(retrieved_docs)
+
+    def query_documents(self, query: str, use_reranker: Optional[bool] = None, session_id: str = DEFAULT_SESSION,
+                        k: Optional[int] = None, fetch_k: Optional[int] = None,
+                        lambda_mult: Optional[float] = None) -> str:
+        return self.query_context(query, session_id=session_id, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult,
+                                  use_reranker=use_reranker).text
+
+    def query_context_batch(self, queries: List[str], session_id: str = DEFAULT_SESSION, k: Optional[int] = None,
+                            fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                            use_reranker: Optional[bool] = None) -> List[PackedContext]:
+        retrieved = self.retrieve_batch(queries, session_id=session_id, k=k, fetch_k=fetch_k,
+                                        lambda_mult=lambda_mult, use_reranker=use_reranker)
+        return [self.pack_context(docs) for docs in retrieved]
 
-    def generate_response(self, query: str, context: str) -> str:
-        rag_chain = (
-              self.prompt
-            | self.llm
-            | StrOutputParser()
+    def _query_context_each(self, queries: List[str], session_id: str = DEFAULT_SESSION, k: Optional[int] = None,
+                            fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                            use_reranker: Optional[bool] = None) -> List[Union[PackedContext, Exception]]:
+        try:
+            return self.query_context_batch(queries, session_id, k, fetch_k, lambda_mult, use_reranker)
+        except Exception as e:
+            print(f"Batched retrieval failed, retrieving queries one by one: {e}")
+        # One bad query fails the whole batched pass; alone, only that query gets the error
+        contexts: List[Union[PackedContext, Exception]] = []
+        for query in queries:
+            try:
+                contexts.append(self.query_context(query, session_id, k, fetch_k, lambda_mult, use_reranker))
+            except Exception as e:
+                contexts.append(e)
+        return contexts
+
+    def _history_enabled(self, session_id: str) -> bool:
+        # Clients that send no session id all share DEFAULT_SESSION, so it keeps no history
+        return self.conversations.max_sessions > 0 and session_id != DEFAULT_SESSION
+
+    def contextualize_query(self, query: str, session_id: str = DEFAULT_SESSION) -> Tuple[str, str]:
+        """(query to retrieve with, conversation history for the prompt)
+
+        Only a follow-up question is retrieved together with the question before it and answered
+        with the history; a standalone question gets neither, so its answer stays cacheable and
+        shared across sessions.
+        """
+        if not self._history_enabled(session_id):
+            return query, ""
+        retrieval_query = rewrite_query(query, self.conversations.last_question(session_id))
+        if retrieval_query == query:
+            return query, ""
+        return retrieval_query, self.conversations.render(session_id)
+
+    def remember_turn(self, session_id: str, query: str, answer: str) -> None:
+        if self._history_enabled(session_id):
+            self.conversations.append(session_id, query, answer)
+
+    @staticmethod
+    def _chain_inputs(query: str, context: str, history: str) -> dict:
+        return {"context": context, "question": query, "history": history or "(this is the first question)"}
+
+    def generate_response(self, query: str, context: str, history: str = "") -> str:
+        cache_key = self._answer_cache_key(query, context, history)
+        answer = self.answer_cache.get(cache_key)
+        if answer is None:
+            with time_stage("llm_generation"):
+                answer = self.sync_rag_chain.invoke(self._chain_inputs(query, context, history))
+            self.answer_cache.put(cache_key, answer)
+        return answer
+
+    def stream_response(self, query: str, context: str, history: str = "") -> Iterator[str]:
+        cache_key = self._answer_cache_key(query, context, history)
+        answer = self.answer_cache.get(cache_key)
+        if answer is not None:
+            yield answer
+            return
+        tokens = []
+        started = time.perf_counter()
+        for token in self.sync_rag_chain.stream(self._chain_inputs(query, context, history)):
+            if not tokens:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+            tokens.append(token)
+            yield token
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_generation")
+        self.answer_cache.put(cache_key, "".join(tokens))
+
+    async def _run_in_executor(self, executor: ThreadPoolExecutor, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+
+    async def _ainvoke_chain(self, inputs: dict) -> str:
+        # The Gemini async client has no REST transport, so REST calls run the sync client in a thread
+        if self.gemini_transport != "rest":
+            return await self.rag_chain.ainvoke(inputs)
+        return await asyncio.to_thread(self.rag_chain.invoke, inputs)
+
+    async def _astream_chain(self, inputs: dict) -> AsyncIterator[str]:
+        if self.gemini_transport != "rest":
+            async for token in self.rag_chain.astream(inputs):
+                yield token
+            return
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue()
+        finished = object()
+
+        def produce() -> None:
+            try:
+                for token in self.rag_chain.stream(inputs):
+                    loop.call_soon_threadsafe(tokens.put_nowait, token)
+                loop.call_soon_threadsafe(tokens.put_nowait, finished)
+            except Exception as e:
+                loop.call_soon_threadsafe(tokens.put_nowait, e)
+
+        producer = loop.run_in_executor(None, produce)
+        while True:
+            token = await tokens.get()
+            if token is finished:
+                break
+            if isinstance(token, Exception):
+                raise token
+            yield token
+        await producer
+
+    @property
+    def llm_semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the serving event loop
+        if self._llm_semaphore is None:
+            self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        return self._llm_semaphore
+
+    @asynccontextmanager
+    async def _llm_slot(self, deadline: float) -> AsyncIterator[None]:
+        # Waiting for a free slot counts against the deadline like the call itself
+        try:
+            await asyncio.wait_for(self.llm_semaphore.acquire(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            self.llm_guard.deadline_exceeded += 1
+            raise LLMUnavailableError("Deadline exceeded waiting for a Gemini slot", "deadline_exceeded")
+        try:
+            yield
+        finally:
+            self.llm_semaphore.release()
+
+    async def aquery_context(self, query: str, session_id: str = DEFAULT_SESSION, k: Optional[int] = None,
+                             fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                             use_reranker: Optional[bool] = None) -> PackedContext:
+        mmr_params = self._mmr_params(k, fetch_k, lambda_mult)
+        use_reranker = self.rerank_enabled if use_reranker is None else use_reranker
+        flight_key = self._retrieval_cache_key(query, session_id, mmr_params, use_reranker)
+        return await self.retrieval_flights.do(
+            flight_key,
+            lambda: self._run_in_executor(self.retrieval_executor, self.query_context, query, session_id,
+                                          *mmr_params, use_reranker),
         )
-        return rag_chain.invoke({"context": context, "question": query})
+
+    async def _agenerate_uncached(self, query: str, context: str, history: str, cache_key: tuple,
+                                  deadline: float) -> str:
+        inputs = self._chain_inputs(query, context, history)
+        async with self._llm_slot(deadline):
+            with time_stage("llm_generation"):
+                answer = await self.llm_guard.invoke(lambda: self._ainvoke_chain(inputs), deadline)
+        self.answer_cache.put(cache_key, answer)
+        return answer
+
+    async def agenerate_response(self, query: str, context: str, deadline: Optional[float] = None,
+                                 history: str = "") -> str:
+        """Gemini's answer, or LLMUnavailableError once the deadline (time.monotonic()) cannot be met"""
+        cache_key = self._answer_cache_key(query, context, history)
+        answer = self.answer_cache.get(cache_key)
+        if answer is None:
+            deadline = self.llm_guard.deadline() if deadline is None else deadline
+            # Coalesced callers share the first caller's deadline, but none waits past its own
+            flight = self.generation_flights.do(cache_key,
+                                                lambda: self._agenerate_uncached(query, context, history, cache_key,
+                                                                                 deadline))
+            try:
+                answer = await asyncio.wait_for(flight, deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                self.llm_guard.deadline_exceeded += 1
+                raise LLMUnavailableError("Deadline exceeded waiting for Gemini", "deadline_exceeded")
+        return answer
+
+    async def astream_response(self, query: str, context: str, deadline: Optional[float] = None,
+                               history: str = "") -> AsyncIterator[str]:
+        cache_key = self._answer_cache_key(query, context, history)
+        answer = self.answer_cache.get(cache_key)
+        if answer is not None:
+            yield answer
+            return
+        deadline = self.llm_guard.deadline() if deadline is None else deadline
+        inputs = self._chain_inputs(query, context, history)
+        tokens = []
+        async with self._llm_slot(deadline):
+            started = time.perf_counter()
+            async for token in self.llm_guard.stream(lambda: self._astream_chain(inputs), deadline):
+                if not tokens:
+                    STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+                tokens.append(token)
+                yield token
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_generation")
+        self.answer_cache.put(cache_key, "".join(tokens))
+
+    async def aquery_batch(self, queries: List[str], session_id: str = DEFAULT_SESSION,
+                           max_concurrency: Optional[int] = None, k: Optional[int] = None,
+                           fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                           use_reranker: Optional[bool] = None) -> List[dict]:
+        # Packing counts tokens for every item, so it runs in the executor with retrieval
+        contexts = await self._run_in_executor(self.retrieval_executor, self._query_context_each, queries,
+                                               session_id, k, fetch_k, lambda_mult, use_reranker)
+        semaphore = asyncio.Semaphore(max_concurrency or self.batch_llm_concurrency)
+
+        async def answer(query: str, packed: Union[PackedContext, Exception]) -> dict:
+            if isinstance(packed, Exception):
+                return {"query": query, "answer": None, "source_documents": None, "error": str(packed),
+                        "degraded": False}
+            result = {"query": query, "answer": None, "source_documents": packed.text, "error": None,
+                      "degraded": False, **packed.token_counts()}
+            try:
+                async with semaphore:
+                    # Each item's deadline starts when it gets a slot, not when the batch arrived
+                    result["answer"] = await self.agenerate_response(query, packed.text, self.llm_guard.deadline())
+            except LLMUnavailableError as e:
+                # The retrieved context still goes back, flagged as answered without Gemini
+                result["error"] = str(e)
+                result["degraded"] = True
+            except Exception as e:
+                result["error"] = str(e)
+            return result
+
+        return await asyncio.gather(*[answer(query, packed) for query, packed in zip(queries, contexts)])
+
+    async def acleanup_session_documents(self, session_id: str = DEFAULT_SESSION) -> None:
+        await self._run_in_executor(self.retrieval_executor, self.cleanup_session_documents, session_id)
+
+    def close(self) -> None:
+        self.retrieval_executor.shutdown(wait=False, cancel_futures=True)
+        # Only the session chunks this process indexed; another process may share the store
+        with self._index_lock:
+            session_chunk_ids = [chunk_id for ids in self.fingerprint_chunk_ids.values() for chunk_id in ids]
+            self.fingerprint_chunk_ids.clear()
+            self.session_fingerprints.clear()
+            self.fingerprint_sessions.clear()
+        if session_chunk_ids:
+            try:
+                self.delete_chunks(session_chunk_ids)
+            except Exception as e:
+                print(f"Error removing session documents on shutdown: {e}")
+        if self._embedding_batcher is not None:
+            self._embedding_batcher.close()
+        self.embedding_cache.close()
+        if isinstance(self._vector_store, NumpyVectorStore):
+            self._vector_store.close()
+
+    def cache_stats(self) -> dict:
+        return {
+            "index_version": self.index_version,
+            "embedding_cache": self.embedding_cache.stats(),
+            "embedding_batcher": self._embedding_batcher.stats() if self._embedding_batcher else None,
+            "retrieval_cache": self.retrieval_cache.stats(),
+            "answer_cache": self.answer_cache.stats(),
+            "llm": self.llm_guard.stats(),
+            "conversations": self.conversations.stats(),
+            "retrieval_flights": self.retrieval_flights.stats(),
+            "generation_flights": self.generation_flights.stats(),
+            "reranker": self._reranker.stats() if self._reranker else None,
+        }
         
 
 if __name__ == "__main__":
@@ -215,15 +1030,14 @@ if __name__ == "__main__":
     index_new_docs = input("Do you want to index new documents? (y/n): ").lower() == 'y'
     
     if index_new_docs:
-        documents = textRAG_instance.find_documents()
+        # Only new or changed files are parsed; chunks of removed files are dropped
+        summary = sync_directory(textRAG_instance,
+                                 manifest_path=os.getenv("RAG_SYNC_MANIFEST", "./sync_manifest.json"),
+                                 workers=int(os.getenv("RAG_SYNC_WORKERS", "4")))
         print("-" * 20)
-        print(f"Found {len(documents)} documents in the directory.")
-        for doc in documents:
-            print(f"- {doc}")
+        print(f"Synced {textRAG_instance.folder_path}: {summary['added']} added, {summary['changed']} changed, "
+              f"{summary['removed']} removed, {summary['unchanged']} unchanged, {summary['failed']} failed")
         print("-" * 20, "\n")
-        
-        loaded_docs = textRAG_instance.index_documents(documents)
-        print(f"Indexed {len(loaded_docs)} documents into the vector store.")
     
     while True:
         query = input("Enter your query: ")
@@ -231,8 +1045,8 @@ if __name__ == "__main__":
             break
         
         else:
-            # Use ColBERT reranking
-            context = textRAG_instance.query_documents(query, use_reranker=True)
+            # Reranked with the cross-encoder when RAG_RERANK is enabled
+            context = textRAG_instance.query_documents(query)
 
             response = textRAG_instance.generate_response(query, context)
             print(response)
\ No newline at end of file
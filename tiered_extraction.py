@@ -0,0 +1,155 @@
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+TEXT_TIER = "text"
+DOCLING_TIER = "docling"
+
+# A page goes to Docling when images cover more of it than this, or it has more vector paths
+# (ruled tables, diagrams) than MAX_PATH_OBJECTS
+MAX_IMAGE_COVERAGE = 0.5
+MAX_PATH_OBJECTS = 400
+MIN_PRINTABLE_RATIO = 0.95
+
+SENTENCE_END = re.compile(r"[.!?:;]['\")\]]?$")
+
+
+def classify_pages(file_path: str, min_chars: int = 200) -> List[str]:
+    """Tier for each page: TEXT_TIER if its text layer can be used as is, else DOCLING_TIER"""
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+
+    tiers = []
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            text = page.get_textpage().get_text_range().strip()
+            printable = sum(1 for char in text if char.isprintable() or char.isspace())
+            if len(text) < min_chars or printable < MIN_PRINTABLE_RATIO * len(text):
+                # Scanned, nearly empty, or text in fonts that do not map back to characters
+                tiers.append(DOCLING_TIER)
+                continue
+            width, height = page.get_size()
+            image_area = 0.0
+            paths = 0
+            for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE, pdfium_c.FPDF_PAGEOBJ_PATH)):
+                if obj.type == pdfium_c.FPDF_PAGEOBJ_IMAGE:
+                    left, bottom, right, top = obj.get_pos()
+                    image_area += (right - left) * (top - bottom)
+                else:
+                    paths += 1
+            complex_layout = image_area > MAX_IMAGE_COVERAGE * width * height or paths > MAX_PATH_OBJECTS
+            tiers.append(DOCLING_TIER if complex_layout else TEXT_TIER)
+    finally:
+        pdf.close()
+    return tiers
+
+
+def plan_tasks(file_path: str, fast_path: bool = True, min_chars: int = 200,
+               pages_per_task: int = 4) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    """Split a file into (tier, first page, last page) runs, 1-based and inclusive
+
+    Consecutive pages of one tier form a run; runs are capped at pages_per_task so a large
+    document converts in parallel. Non-PDF files, or PDFs pypdfium2 cannot open, are one
+    whole-file Docling task with no page range.
+    """
+    if not fast_path or Path(file_path).suffix.lower() != ".pdf":
+        return [(DOCLING_TIER, None, None)]
+    try:
+        tiers = classify_pages(file_path, min_chars=min_chars)
+    except Exception as e:
+        print(f"Page classification failed for {file_path}, using Docling for the whole file: {e}")
+        return [(DOCLING_TIER, None, None)]
+
+    tasks = []
+    for page_number, tier in enumerate(tiers, start=1):
+        if tasks and tasks[-1][0] == tier and page_number - tasks[-1][1] < pages_per_task:
+            tasks[-1] = (tier, tasks[-1][1], page_number)
+        else:
+            tasks.append((tier, page_number, page_number))
+    return tasks
+
+
+def _paragraphs(page_text: str) -> List[str]:
+    # Lines that end a sentence and stop short of the full line width close a paragraph
+    lines = [line.strip() for line in page_text.splitlines()]
+    widest = max((len(line) for line in lines), default=0)
+    paragraphs, current = [], []
+    for line in lines:
+        if not line:
+            if current:
+                paragraphs.append(current)
+                current = []
+            continue
+        if current and current[-1].endswith("-") and not current[-1].endswith(" -"):
+            current[-1] = current[-1][:-1] + line
+        else:
+            current.append(line)
+        if SENTENCE_END.search(line) and len(line) < 0.8 * widest:
+            paragraphs.append(current)
+            current = []
+    if current:
+        paragraphs.append(current)
+    return [" ".join(paragraph) for paragraph in paragraphs]
+
+
+def text_layer_document(file_path: str, first_page: int, last_page: int):
+    """DoclingDocument of the text layer of pages first_page..last_page, one text item per paragraph"""
+    import pypdfium2 as pdfium
+    from docling_core.types.doc import DocItemLabel, DoclingDocument
+
+    document = DoclingDocument(name=Path(file_path).stem)
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        for index in range(first_page - 1, last_page):
+            for paragraph in _paragraphs(pdf[index].get_textpage().get_text_range()):
+                document.add_text(label=DocItemLabel.TEXT, text=paragraph)
+    finally:
+        pdf.close()
+    return document
+
+
+def docling_document(converter, file_path: str, first_page: Optional[int], last_page: Optional[int]):
+    if first_page is None:
+        return converter.convert(file_path).document
+
+    # The page run is copied into its own small PDF so any Docling version converts just those pages
+    import pypdfium2 as pdfium
+
+    source = pdfium.PdfDocument(file_path)
+    excerpt = pdfium.PdfDocument.new()
+    try:
+        excerpt.import_pages(source, list(range(first_page - 1, last_page)))
+        with tempfile.TemporaryDirectory(prefix="rag-pages-") as tmp_dir:
+            excerpt_path = Path(tmp_dir) / f"{Path(file_path).stem}_p{first_page}-{last_page}.pdf"
+            excerpt.save(str(excerpt_path))
+            return converter.convert(str(excerpt_path)).document
+    finally:
+        excerpt.close()
+        source.close()
+
+
+def convert_task(file_path: str, tier: str, first_page: Optional[int], last_page: Optional[int],
+                 chunker, converter=None, timings: Optional[Dict[str, float]] = None,
+                 on_parsed: Optional[Callable[[], None]] = None) -> List[str]:
+    """Chunk texts for one planned task; both tiers go through the same HybridChunker
+
+    Seconds spent parsing and chunking are added to timings["parse"] and timings["chunk"] if given,
+    and on_parsed is called between the two.
+    """
+    started = time.perf_counter()
+    if tier == TEXT_TIER:
+        document = text_layer_document(file_path, first_page, last_page)
+    else:
+        document = docling_document(converter, file_path, first_page, last_page)
+    parsed = time.perf_counter()
+    if on_parsed is not None:
+        on_parsed()
+    texts = [chunker.contextualize(chunk=chunk) for chunk in chunker.chunk(document)]
+    if timings is not None:
+        timings["parse"] = timings.get("parse", 0.0) + parsed - started
+        timings["chunk"] = timings.get("chunk", 0.0) + time.perf_counter() - parsed
+    return texts